@@ -2,7 +2,21 @@ from django.contrib import admin
 from .models import User, Pictograma, Audio, Rutina
 
 
+class ContentAdmin(admin.ModelAdmin):
+    # __str__ muestra el email del autor: se trae en la misma consulta
+    list_display = ('__str__', 'es_precargado', 'ultima_modificacion')
+    list_filter = ('es_precargado',)
+    list_select_related = ('autor',)
+    search_fields = ('nombre',)
+
+
+class RutinaAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'version', 'ultima_modificacion')
+    list_select_related = ('autor',)
+    search_fields = ('nombre',)
+
+
 admin.site.register(User)
-admin.site.register(Pictograma)
-admin.site.register(Audio)
-admin.site.register(Rutina)
+admin.site.register(Pictograma, ContentAdmin)
+admin.site.register(Audio, ContentAdmin)
+admin.site.register(Rutina, RutinaAdmin)
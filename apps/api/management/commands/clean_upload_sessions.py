@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from apps.api.utils import remove_expired_upload_sessions
+from apps.api.utils import remove_orphan_upload_parts
+
+
+class Command(BaseCommand):
+    help = (
+        'Elimina las subidas por partes vencidas de todos los usuarios, '
+        'liberando su espacio reservado, y los archivos parciales huérfanos'
+    )
+
+    def handle(self, *args, **options):
+        sessions = remove_expired_upload_sessions()
+        parts = remove_orphan_upload_parts()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Subidas vencidas eliminadas con éxito: {sessions} subidas, '
+            f'{parts} archivos parciales huérfanos.'
+        ))
@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import mimetypes
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from rest_framework.exceptions import APIException
+
+from simple_history.utils import bulk_create_with_history
+from simple_history.utils import bulk_update_with_history
+
+from apps.api.models import User, Pictograma, Audio, ProcessingJob
+from apps.api.models import normalize_name
+from apps.api.utils import filename_generator, set_file_permissions
+from apps.api.utils import generate_derivatives, remove_derivatives
+from apps.api.utils import is_blob_path, release_blob
+from apps.api.utils import bump_preloaded_catalog
+from apps.api.utils import TEMP_FILE_PREFIX, READ_SIZE
+from apps.api.validators import verify_content_name, verify_mime_type
+
+
+# Modelo y carpeta de 'preloaded/' de cada tipo de contenido del manifiesto
+CONTENT_TYPES = {
+    'pictograma': (Pictograma, 'pictograms'),
+    'audio': (Audio, 'sounds'),
+}
+
+
+class LibrarySource:
+    """
+    Acceso de sólo lectura a los archivos de la biblioteca, ya sea dentro de
+    un ZIP o de una carpeta. Los archivos del ZIP se leen por partes, sin
+    extraerlos completos.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+
+        if self.archive is None and not os.path.isdir(path):
+            raise CommandError(f'No se encontró el ZIP o carpeta: {path}')
+
+    def open(self, name):
+        if self.archive is not None:
+            return self.archive.open(name)
+
+        return open(os.path.join(self.path, name), 'rb')
+
+    def exists(self, name):
+        if self.archive is not None:
+            return name in self.archive.NameToInfo
+
+        return os.path.isfile(os.path.join(self.path, name))
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+def hash_path(file_path):
+    digest = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def import_entry(source, entry, existing):
+    """
+    Copia un archivo de la biblioteca a 'preloaded/', calculando su hash
+    mientras se escribe. Si es idéntico al del contenido ya importado con el
+    mismo nombre, se descarta y el contenido queda sin cambios.
+
+    NOTA: No consulta la base de datos, por lo que se ejecuta en paralelo.
+    """
+    model, content_folder = CONTENT_TYPES[entry['tipo']]
+    folder = os.path.join(settings.MEDIA_ROOT, 'preloaded', content_folder)
+    os.makedirs(folder, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=TEMP_FILE_PREFIX)
+    digest = hashlib.sha256()
+
+    try:
+        with os.fdopen(fd, 'wb') as temp_file, source.open(entry['archivo']) as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(chunk)
+                temp_file.write(chunk)
+
+        old_path = None
+
+        if existing is not None:
+            old_path = os.path.join(settings.MEDIA_ROOT, existing['ruta'])
+
+            if os.path.exists(old_path) and hash_path(old_path) == digest.hexdigest():
+                os.remove(temp_path)
+                return {**entry, 'status': 'unchanged'}
+
+        # Un archivo modificado conserva su ruta si no cambió su extensión
+        # (salvo los blobs compartidos, que nunca se sobrescriben)
+        _, extension = os.path.splitext(entry['archivo'])
+        keeps_path = old_path and old_path.endswith(extension) and \
+            not is_blob_path(existing['ruta'])
+
+        if keeps_path:
+            file_path = old_path
+        else:
+            filename = filename_generator(entry['nombre'], File(None, entry['archivo']))
+            file_path = os.path.join(folder, filename)
+
+        set_file_permissions(temp_path)
+        os.replace(temp_path, file_path)
+
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+    relative_path = os.path.relpath(file_path, settings.MEDIA_ROOT)
+    miniaturas = {}
+
+    if model is Pictograma:
+        if existing is not None and not is_blob_path(existing['ruta']):
+            remove_derivatives(existing['ruta'])
+
+        if not settings.MEDIA_PROCESSING_ASYNC:
+            miniaturas = generate_derivatives(relative_path)
+
+    return {
+        **entry,
+        'status': 'updated' if existing is not None else 'created',
+        'ruta': relative_path,
+        'miniaturas': miniaturas,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Importa (o actualiza) el contenido precargado de pictogramas y audios '
+        'desde un ZIP o carpeta con un manifiesto'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'source',
+            help='ZIP o carpeta con los archivos de la biblioteca.',
+        )
+        parser.add_argument(
+            '--manifest',
+            default='manifest.json',
+            help=(
+                'Manifiesto JSON: lista de objetos con tipo ("pictograma" o '
+                '"audio"), nombre y archivo (ruta dentro del ZIP o carpeta). '
+                'Se busca primero dentro de la biblioteca.'
+            ),
+        )
+        parser.add_argument(
+            '--author',
+            required=True,
+            help='Email del usuario staff al que se asigna el contenido.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Cantidad de hilos que copian archivos en paralelo.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Cantidad de elementos registrados por transacción.',
+        )
+
+    def handle(self, *args, **options):
+        author = User.objects.filter(email=options['author'], is_staff=True).first()
+
+        if author is None:
+            raise CommandError('El autor debe ser un usuario staff existente.')
+
+        source = LibrarySource(options['source'])
+
+        try:
+            entries = self.read_manifest(source, options['manifest'])
+            totals = self.import_entries(source, entries, author, options)
+        finally:
+            source.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Biblioteca importada con éxito: '
+            f'{totals["created"]} nuevos, {totals["updated"]} actualizados, '
+            f'{totals["unchanged"]} sin cambios, {totals["invalid"]} inválidos.'
+        ))
+
+    def read_manifest(self, source, manifest):
+        try:
+            if source.exists(manifest):
+                with source.open(manifest) as f:
+                    entries = json.load(f)
+            else:
+                with open(manifest, 'r') as f:
+                    entries = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'No se pudo leer el manifiesto: {e}')
+
+        valid_entries = []
+        seen = set()
+
+        for entry in entries:
+            error = self.validate_entry(source, entry)
+
+            if not error and (entry['tipo'], entry['nombre']) in seen:
+                error = 'nombre repetido en el manifiesto'
+
+            if error:
+                self.stderr.write(f'Elemento omitido ({error}): {entry}')
+                continue
+
+            seen.add((entry['tipo'], entry['nombre']))
+            valid_entries.append(entry)
+
+        self.invalid_entries = len(entries) - len(valid_entries)
+
+        return valid_entries
+
+    def validate_entry(self, source, entry):
+        try:
+            model, _ = CONTENT_TYPES[entry['tipo']]
+            verify_content_name(entry['nombre'])
+
+            mime_type, _ = mimetypes.guess_type(entry['archivo'])
+            verify_mime_type(mime_type, model._meta.verbose_name)
+        except (KeyError, TypeError):
+            return 'faltan tipo, nombre o archivo'
+        except APIException as e:
+            return str(e.detail) or 'nombre inválido'
+
+        if not source.exists(entry['archivo']):
+            return 'archivo no encontrado'
+
+        return None
+
+    def import_entries(self, source, entries, author, options):
+        totals = {
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'invalid': self.invalid_entries,
+        }
+        existing = {
+            (kind, row['nombre']): row
+            for kind, (model, _) in CONTENT_TYPES.items()
+            for row in model.objects.filter(es_precargado=True).values('id', 'nombre', 'ruta')
+        }
+        batch_size = max(1, options['batch_size'])
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for start in range(0, len(entries), batch_size):
+                batch = entries[start:start + batch_size]
+                results = list(pool.map(
+                    lambda entry: import_entry(
+                        source,
+                        entry,
+                        existing.get((entry['tipo'], entry['nombre']))
+                    ),
+                    batch
+                ))
+
+                self.save_results(results, existing, author)
+
+                for result in results:
+                    totals[result['status']] += 1
+
+                elapsed = max(time.monotonic() - started, 1e-6)
+                done = start + len(batch)
+                self.stdout.write(
+                    f'{done}/{len(entries)} elementos en {elapsed:.1f} s '
+                    f'({done / elapsed:.1f} elementos/s)'
+                )
+
+        return totals
+
+    def save_results(self, results, existing, author):
+        """
+        Registra los resultados de un lote con una inserción y una
+        actualización masivas por modelo.
+        """
+        is_async = settings.MEDIA_PROCESSING_ASYNC
+        replaced_files = []
+
+        with transaction.atomic():
+            for kind, (model, _) in CONTENT_TYPES.items():
+                to_create = []
+                to_update = []
+                now = timezone.now()
+                instances = model.objects.in_bulk([
+                    existing[(kind, result['nombre'])]['id']
+                    for result in results
+                    if result['tipo'] == kind and result['status'] == 'updated'
+                ])
+
+                for result in results:
+                    if result['tipo'] != kind or result['status'] == 'unchanged':
+                        continue
+
+                    if result['status'] == 'created':
+                        content = model(
+                            nombre=result['nombre'],
+                            nombre_normalizado=normalize_name(result['nombre']),
+                            ruta=result['ruta'],
+                            autor=author,
+                            es_precargado=True
+                        )
+                        to_create.append(content)
+                    else:
+                        row = existing[(kind, result['nombre'])]
+                        content = instances[row['id']]
+                        old_path = content.ruta.name
+
+                        if is_blob_path(old_path):
+                            release_blob(old_path)
+                        elif old_path != result['ruta']:
+                            replaced_files.append(old_path)
+
+                        content.ruta = result['ruta']
+                        content.ultima_modificacion = now
+                        to_update.append(content)
+
+                    if model is Pictograma:
+                        content.miniaturas = result['miniaturas']
+                        content.estado = 'pendiente' if is_async else 'listo'
+
+                update_fields = ['ruta', 'ultima_modificacion']
+
+                if model is Pictograma:
+                    update_fields += ['miniaturas', 'estado']
+
+                created = bulk_create_with_history(
+                    to_create,
+                    model,
+                    default_user=author
+                ) if to_create else []
+                bulk_update_with_history(
+                    to_update,
+                    model,
+                    update_fields,
+                    default_user=author
+                )
+
+                if model is Pictograma and is_async:
+                    ProcessingJob.objects.bulk_create([
+                        ProcessingJob(
+                            kind='process_media',
+                            payload={'model': model._meta.label, 'id': content.pk}
+                        )
+                        for content in [*created, *to_update]
+                    ])
+
+            transaction.on_commit(lambda: self.remove_replaced_files(replaced_files))
+
+            # Los registros masivos no envían post_save
+            for model, _ in CONTENT_TYPES.values():
+                transaction.on_commit(lambda model=model: bump_preloaded_catalog(model))
+
+    def remove_replaced_files(self, replaced_files):
+        for relative_path in replaced_files:
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(settings.MEDIA_ROOT, relative_path))
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from rest_framework import exceptions
+
+from apps.api.models import Rutina
+from apps.api.utils import move_routine_document
+
+
+class Command(BaseCommand):
+    help = (
+        'Mueve el JSON de las rutinas a la base de datos o a archivos, según '
+        'ROUTINE_DOCUMENTS_IN_DATABASE (ejecutar al cambiar ese ajuste)'
+    )
+
+    def handle(self, *args, **options):
+        if settings.ROUTINE_DOCUMENTS_IN_DATABASE:
+            destination = 'la base de datos'
+            routines = Rutina.objects.exclude(json_rutina='')
+        else:
+            destination = 'archivos'
+            routines = Rutina.objects.filter(documento__isnull=False)
+
+        routine_ids = list(routines.order_by('id').values_list('id', flat=True))
+        moved = 0
+        failures = 0
+
+        for routine_id in routine_ids:
+            try:
+                moved += move_routine_document(routine_id)
+            except (OSError, ValueError, exceptions.APIException) as e:
+                # La rutina sigue leyéndose desde donde estaba
+                self.stderr.write(f'Rutina {routine_id}: {e}')
+                failures += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rutinas movidas a {destination} con éxito: {moved} movidas, '
+            f'{failures} con errores.'
+        ))
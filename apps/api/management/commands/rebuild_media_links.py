@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from rest_framework.exceptions import APIException
+
+from apps.api.models import Rutina
+from apps.api.utils import get_routine_document, sync_routine_media_links
+
+
+class Command(BaseCommand):
+    help = (
+        'Reconstruye el índice de pictogramas y audios usados en cada rutina '
+        '(e.g. para las rutinas creadas antes de existir el índice)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Cantidad de rutinas indexadas por transacción.',
+        )
+
+    def handle(self, *args, **options):
+        last_id = 0
+        indexed = 0
+        links = 0
+        started = time.monotonic()
+
+        while True:
+            routines = list(
+                Rutina.objects
+                .filter(id__gt=last_id)
+                .order_by('id')[:options['batch_size']]
+            )
+
+            if not routines:
+                break
+
+            with transaction.atomic():
+                for routine in routines:
+                    try:
+                        document = get_routine_document(routine)
+                    except APIException as e:
+                        self.stderr.write(f'Rutina {routine.id}: {e.detail}')
+                        continue
+
+                    links += len(sync_routine_media_links(routine, document))
+                    indexed += 1
+
+            last_id = routines[-1].id
+            elapsed = max(time.monotonic() - started, 1e-6)
+            self.stdout.write(
+                f'{indexed} rutinas en {elapsed:.1f} s '
+                f'({indexed / elapsed:.1f} rutinas/s)'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Índice reconstruido con éxito: {indexed} rutinas, {links} vínculos.'
+        ))
@@ -0,0 +1,380 @@
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.utils import timezone
+
+from apps.api.models import User, UserStorage, MediaBlob
+from apps.api.models import Pictograma, Audio, Rutina
+from apps.api.utils import scan_storage_folder
+from apps.api.utils import STORAGE_FIELDS, CONTENT_FOLDERS
+from apps.api.utils import get_document_size
+from apps.api.utils import get_upload_session_reservations
+
+
+LEDGER_FIELDS = ['used_storage', *STORAGE_FIELDS.values()]
+
+# Conexiones a la base de datos heredadas del proceso padre, que los procesos
+# del pool conservan sin cerrar (cerrarlas terminaría la sesión del padre)
+inherited_connections = []
+
+
+def init_worker():
+    """
+    Inicializador de los procesos del pool. El pool los crea a medida que
+    los necesita, incluso después de que el proceso padre volvió a consultar
+    la base de datos, por lo que pueden heredar su conexión abierta. Se 
+    desvincula de Django sin cerrarla: si el proceso consultara la base de 
+    datos, abriría su propia conexión.
+    """
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is not None:
+            inherited_connections.append(connection.connection)
+            connection.connection = None
+
+
+def scan_user(user_id):
+    """
+    Tarea ejecutada en los procesos del pool: sólo recorre el disco.
+    """
+    try:
+        breakdown, files = scan_storage_folder(user_id)
+        return user_id, breakdown, files, None
+    except OSError as e:
+        return user_id, None, [], str(e)
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalcula el almacenamiento en disco de cada usuario y corrige '
+        'sus contadores de almacenamiento'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Cantidad de procesos que recorren el disco en paralelo.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Cantidad de usuarios procesados por lote.',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default=os.path.join(settings.BASE_DIR, 'reconcile_storage.checkpoint'),
+            help=(
+                'Archivo donde se guarda el último usuario procesado (por '
+                'defecto, en la carpeta del proyecto).'
+            ),
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Continúa desde el último usuario guardado en el checkpoint.',
+        )
+        parser.add_argument(
+            '--reset-reservations',
+            action='store_true',
+            help=(
+                'Libera las reservas de almacenamiento pendientes, salvo las '
+                'de subidas por partes abiertas.'
+            ),
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Sólo informa las diferencias, sin escribir en la base de datos.',
+        )
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint']
+        last_user_id = self.read_checkpoint(checkpoint) if options['resume'] else 0
+
+        if last_user_id:
+            self.stdout.write(f'Reanudando desde el usuario {last_user_id}.')
+
+        totals = {
+            'users': 0,
+            'files': 0,
+            'corrected': 0,
+            'orphans': 0,
+            'missing': 0,
+        }
+        started = time.monotonic()
+
+        with ProcessPoolExecutor(
+            max_workers=options['workers'], 
+            initializer=init_worker
+        ) as pool:
+            while True:
+                user_ids = list(
+                    User.objects
+                    .filter(id__gt=last_user_id)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:options['batch_size']]
+                )
+
+                if not user_ids:
+                    break
+
+                results = list(pool.map(scan_user, user_ids, chunksize=16))
+                stats = self.reconcile_batch(results, options)
+
+                for key, value in stats.items():
+                    totals[key] += value
+
+                last_user_id = user_ids[-1]
+
+                if not options['dry_run']:
+                    self.write_checkpoint(checkpoint, last_user_id)
+
+                self.report_progress(totals, started)
+
+        if not options['dry_run'] and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        self.report_progress(totals, started)
+        self.stdout.write(self.style.SUCCESS(
+            'Almacenamiento reconciliado con éxito: '
+            f'{totals["corrected"]} contadores corregidos, '
+            f'{totals["orphans"]} archivos sin referencia, '
+            f'{totals["missing"]} referencias sin archivo.'
+        ))
+
+    def reconcile_batch(self, results, options):
+        """
+        Compara el recorrido del disco con los contadores del lote y corrige
+        los que no coinciden.
+
+        El recorrido paralelo se hizo sin bloqueo, por lo que sólo sirve para
+        encontrar los contadores desactualizados: éstos se bloquean con 
+        select_for_update (lo que detiene las subidas y eliminaciones de esos
+        usuarios hasta confirmar), se vuelve a recorrer su carpeta y recién 
+        entonces se corrigen. Se omiten los usuarios con subidas en curso 
+        (almacenamiento reservado fuera de sus subidas por partes abiertas),
+        salvo con --reset-reservations.
+        """
+        stats = {
+            'users': len(results),
+            'files': 0,
+            'corrected': 0,
+            'orphans': 0,
+            'missing': 0,
+        }
+        user_ids = [user_id for user_id, *_ in results]
+        referenced = self.get_referenced_files(user_ids)
+        blob_usage = self.get_blob_usage(user_ids)
+        document_usage = self.get_document_usage(user_ids)
+        ledgers = UserStorage.objects.in_bulk(user_ids, field_name='user_id')
+        outdated_ids = []
+
+        for user_id, breakdown, files, error in results:
+            if error:
+                self.stderr.write(f'Usuario {user_id}: {error}')
+                continue
+
+            stats['files'] += len(files)
+
+            # Compara lo que hay en disco con lo que referencia la base de datos
+            on_disk = set(files)
+            user_references = referenced.get(user_id, set())
+            stats['orphans'] += len(on_disk - user_references)
+            stats['missing'] += len(user_references - on_disk)
+
+            self.add_blob_usage(breakdown, blob_usage.get(user_id, {}))
+            self.add_blob_usage(breakdown, document_usage.get(user_id, {}))
+            ledger = ledgers.get(user_id)
+
+            if ledger is None or options['reset_reservations'] or \
+                    self.is_outdated(ledger, breakdown):
+                outdated_ids.append(user_id)
+
+        if options['dry_run']:
+            stats['corrected'] = len(outdated_ids)
+        elif outdated_ids:
+            stats['corrected'] = self.correct_ledgers(outdated_ids, options)
+
+        return stats
+
+    @transaction.atomic
+    def correct_ledgers(self, user_ids, options):
+        now = timezone.now()
+        locked = {
+            ledger.user_id: ledger
+            for ledger in UserStorage.objects.select_for_update().filter(
+                user_id__in=user_ids
+            )
+        }
+        blob_usage = self.get_blob_usage(user_ids)
+        document_usage = self.get_document_usage(user_ids)
+        session_reservations = get_upload_session_reservations(user_ids)
+        to_update = []
+        to_create = []
+
+        for user_id in user_ids:
+            ledger = locked.get(user_id)
+
+            # Las subidas por partes abiertas mantienen su reserva hasta 
+            # finalizarse; sólo el resto corresponde a subidas en curso
+            session_reserved = session_reservations.get(user_id, 0)
+
+            if ledger is not None and \
+                    ledger.reserved_storage > session_reserved and \
+                    not options['reset_reservations']:
+                self.stderr.write(
+                    f'Usuario {user_id}: omitido por tener subidas en curso.'
+                )
+                continue
+
+            try:
+                breakdown, _ = scan_storage_folder(user_id)
+            except OSError as e:
+                self.stderr.write(f'Usuario {user_id}: {e}')
+                continue
+
+            self.add_blob_usage(breakdown, blob_usage.get(user_id, {}))
+            self.add_blob_usage(breakdown, document_usage.get(user_id, {}))
+
+            if ledger is None:
+                to_create.append(UserStorage(user_id=user_id, **breakdown))
+                continue
+
+            if not self.is_outdated(ledger, breakdown) and \
+                    not options['reset_reservations']:
+                continue
+
+            for field in LEDGER_FIELDS:
+                setattr(ledger, field, breakdown[field])
+
+            if options['reset_reservations']:
+                ledger.reserved_storage = session_reserved
+
+            ledger.updated_at = now
+            to_update.append(ledger)
+
+        update_fields = [*LEDGER_FIELDS, 'updated_at']
+
+        if options['reset_reservations']:
+            update_fields.append('reserved_storage')
+
+        UserStorage.objects.bulk_create(to_create, ignore_conflicts=True)
+        UserStorage.objects.bulk_update(to_update, update_fields)
+
+        return len(to_create) + len(to_update)
+
+    def is_outdated(self, ledger, breakdown):
+        return any(
+            getattr(ledger, field) != breakdown[field]
+            for field in LEDGER_FIELDS
+        )
+
+    def add_blob_usage(self, breakdown, usage):
+        # Los blobs compartidos y los documentos de rutinas guardados en la
+        # base de datos no están en su carpeta, pero sí le cuentan
+        for field, size in usage.items():
+            breakdown['used_storage'] += size
+            breakdown[field] += size
+
+    def get_referenced_files(self, user_ids):
+        """
+        Retorna, por usuario, las rutas relativas que referencia la base de
+        datos dentro de su carpeta de contenido.
+        """
+        referenced = {}
+        querysets = [
+            Pictograma.objects.values_list('autor_id', 'ruta'),
+            Audio.objects.values_list('autor_id', 'ruta'),
+            Rutina.objects.values_list('autor_id', 'url_portada'),
+            Rutina.objects.values_list('autor_id', 'json_rutina'),
+        ]
+
+        for queryset in querysets:
+            for user_id, path in queryset.filter(autor_id__in=user_ids):
+                if path and path.startswith(f'user_content{os.sep}{user_id}{os.sep}'):
+                    referenced.setdefault(user_id, set()).add(os.path.normpath(path))
+
+        return referenced
+
+    def get_blob_usage(self, user_ids):
+        """
+        Retorna, por usuario, los bytes de los blobs que referencia su 
+        contenido propio (almacenamiento por contenido).
+        """
+        references = []
+
+        for model in (Pictograma, Audio):
+            content_field = STORAGE_FIELDS[CONTENT_FOLDERS[model._meta.verbose_name]]
+            queryset = model.objects.filter(
+                autor_id__in=user_ids,
+                es_precargado=False,
+                ruta__startswith='blobs/',
+            ).values_list('autor_id', 'ruta')
+
+            for user_id, path in queryset:
+                file_hash, _ = os.path.splitext(os.path.basename(path))
+                references.append((user_id, content_field, file_hash))
+
+        blobs = MediaBlob.objects.in_bulk(
+            {file_hash for *_, file_hash in references}, 
+            field_name='hash'
+        )
+        usage = {}
+
+        for user_id, content_field, file_hash in references:
+            if file_hash in blobs:
+                user_usage = usage.setdefault(user_id, {})
+                user_usage[content_field] = \
+                    user_usage.get(content_field, 0) + blobs[file_hash].size
+
+        return usage
+
+    def get_document_usage(self, user_ids):
+        """
+        Retorna, por usuario, los bytes de los JSON de rutinas guardados en 
+        la base de datos (las rutinas con archivo ya se cuentan en disco).
+        """
+        queryset = Rutina.objects.filter(
+            autor_id__in=user_ids,
+            autor__is_staff=False,
+            json_rutina='',
+            documento__isnull=False,
+        ).values_list('autor_id', 'documento')
+        usage = {}
+
+        for user_id, document in queryset.iterator(chunk_size=500):
+            user_usage = usage.setdefault(user_id, {'routines_size': 0})
+            user_usage['routines_size'] += get_document_size(document)
+
+        return usage
+
+    def read_checkpoint(self, checkpoint):
+        try:
+            with open(checkpoint, 'r') as file:
+                return int(file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_checkpoint(self, checkpoint, user_id):
+        temp_path = f'{checkpoint}.tmp'
+
+        with open(temp_path, 'w') as file:
+            file.write(str(user_id))
+
+        os.replace(temp_path, checkpoint)
+
+    def report_progress(self, totals, started):
+        elapsed = max(time.monotonic() - started, 1e-6)
+
+        self.stdout.write(
+            f'{totals["users"]} usuarios, {totals["files"]} archivos en '
+            f'{elapsed:.1f} s ({totals["users"] / elapsed:.1f} usuarios/s, '
+            f'{totals["files"] / elapsed:.1f} archivos/s)'
+        )
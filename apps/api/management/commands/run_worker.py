@@ -0,0 +1,89 @@
+import os
+import time
+import socket
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+# Registra los tipos de tarea (e.g. 'process_media') definidos en utils
+import apps.api.utils  # noqa: F401
+from apps.api.tasks import claim_job, run_job, requeue_stale_jobs
+
+
+def worker_loop(worker_id, poll_interval, run_once):
+    """
+    Reclama y ejecuta tareas hasta que se detenga el proceso o, con
+    run_once, hasta que la cola quede vacía.
+    """
+    while True:
+        close_old_connections()
+        requeue_stale_jobs()
+
+        job = claim_job(worker_id)
+
+        if job is not None:
+            run_job(job)
+            continue
+
+        if run_once:
+            break
+
+        time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = 'Ejecuta las tareas en segundo plano (e.g. miniaturas) de la cola'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help='Cantidad de procesos que ejecutan tareas en paralelo.',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Segundos de espera cuando la cola está vacía.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Termina cuando ya no quedan tareas pendientes.',
+        )
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        poll_interval = options['poll_interval']
+        run_once = options['once']
+        worker_prefix = f'{socket.gethostname()}:{os.getpid()}'
+
+        self.stdout.write(f'Iniciando {processes} proceso(s) de trabajo.')
+
+        if processes == 1:
+            worker_loop(f'{worker_prefix}:0', poll_interval, run_once)
+        else:
+            # Los procesos hijos no deben heredar conexiones abiertas
+            connections.close_all()
+
+            workers = [
+                multiprocessing.Process(
+                    target=worker_loop,
+                    args=(f'{worker_prefix}:{number}', poll_interval, run_once),
+                )
+                for number in range(processes)
+            ]
+
+            for worker in workers:
+                worker.start()
+
+            try:
+                for worker in workers:
+                    worker.join()
+            except KeyboardInterrupt:
+                for worker in workers:
+                    worker.terminate()
+
+        self.stdout.write(self.style.SUCCESS('Procesamiento finalizado.'))
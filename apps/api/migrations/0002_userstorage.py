@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStorage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('used_storage', models.PositiveBigIntegerField(default=0)),
+                ('pictograms_size', models.PositiveBigIntegerField(default=0)),
+                ('sounds_size', models.PositiveBigIntegerField(default=0)),
+                ('covers_size', models.PositiveBigIntegerField(default=0)),
+                ('routines_size', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='storage', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'User storage',
+                'verbose_name_plural': 'User storage',
+            },
+        ),
+    ]
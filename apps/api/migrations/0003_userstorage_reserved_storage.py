@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_userstorage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstorage',
+            name='reserved_storage',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalpictograma',
+            name='miniaturas',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Miniaturas'),
+        ),
+        migrations.AddField(
+            model_name='historicalrutina',
+            name='miniaturas',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Miniaturas de la portada'),
+        ),
+        migrations.AddField(
+            model_name='pictograma',
+            name='miniaturas',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Miniaturas'),
+        ),
+        migrations.AddField(
+            model_name='rutina',
+            name='miniaturas',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Miniaturas de la portada'),
+        ),
+    ]
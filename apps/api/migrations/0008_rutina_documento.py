@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalrutina',
+            name='documento',
+            field=models.JSONField(blank=True, null=True, verbose_name='Documento de la rutina'),
+        ),
+        migrations.AddField(
+            model_name='rutina',
+            name='documento',
+            field=models.JSONField(blank=True, null=True, verbose_name='Documento de la rutina'),
+        ),
+    ]
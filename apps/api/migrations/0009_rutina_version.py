@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_rutina_documento'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalrutina',
+            name='version',
+            field=models.PositiveIntegerField(default=1, verbose_name='Versión'),
+        ),
+        migrations.AddField(
+            model_name='rutina',
+            name='version',
+            field=models.PositiveIntegerField(default=1, verbose_name='Versión'),
+        ),
+    ]
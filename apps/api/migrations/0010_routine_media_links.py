@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_rutina_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoutineMediaLink',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('audio', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='routine_links', to='api.audio')),
+                ('pictograma', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='routine_links', to='api.pictograma')),
+                ('rutina', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_links', to='api.rutina')),
+            ],
+            options={
+                'verbose_name': 'Routine media link',
+                'verbose_name_plural': 'Routine media links',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='routinemedialink',
+            constraint=models.UniqueConstraint(fields=('rutina', 'pictograma'), name='unique_routine_pictogram_link'),
+        ),
+        migrations.AddConstraint(
+            model_name='routinemedialink',
+            constraint=models.UniqueConstraint(fields=('rutina', 'audio'), name='unique_routine_audio_link'),
+        ),
+    ]
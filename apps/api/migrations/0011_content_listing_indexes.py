@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_routine_media_links'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='audio',
+            index=models.Index(fields=['autor', 'ultima_modificacion'], name='audio_autor_mod_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audio',
+            index=models.Index(condition=models.Q(('es_precargado', True)), fields=['ultima_modificacion', 'id'], name='audio_preloaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pictograma',
+            index=models.Index(fields=['autor', 'ultima_modificacion'], name='pictograma_autor_mod_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pictograma',
+            index=models.Index(condition=models.Q(('es_precargado', True)), fields=['ultima_modificacion', 'id'], name='pictograma_preloaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rutina',
+            index=models.Index(fields=['autor', 'ultima_modificacion'], name='rutina_autor_mod_idx'),
+        ),
+    ]
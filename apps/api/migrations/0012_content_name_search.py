@@ -0,0 +1,101 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:45
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+CONTENT_MODELS = ('Pictograma', 'Audio')
+
+
+def normalize_name(value):
+    # Copia de apps.api.models.normalize_name al momento de esta migración
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    value = ' '.join(value.lower().split())
+
+    return value[:50].rstrip()
+
+
+def backfill_normalized_names(apps, schema_editor):
+    for model_name in CONTENT_MODELS:
+        model = apps.get_model('api', model_name)
+        batch = []
+
+        for content in model.objects.only('id', 'nombre').iterator(chunk_size=500):
+            content.nombre_normalizado = normalize_name(content.nombre)
+            batch.append(content)
+
+            if len(batch) >= 500:
+                model.objects.bulk_update(batch, ['nombre_normalizado'])
+                batch = []
+
+        model.objects.bulk_update(batch, ['nombre_normalizado'])
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """
+    En PostgreSQL, agrega índices de trigramas (pg_trgm) para las búsquedas
+    por nombre que no son por prefijo (LIKE '%texto%'). Las demás bases de 
+    datos sólo cuentan con el índice por prefijo.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    for model_name in CONTENT_MODELS:
+        table = apps.get_model('api', model_name)._meta.db_table
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {table}_nombre_trgm_idx '
+            f'ON {table} USING gin (nombre_normalizado gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    
+    for model_name in CONTENT_MODELS:
+        table = apps.get_model('api', model_name)._meta.db_table
+        schema_editor.execute(f'DROP INDEX IF EXISTS {table}_nombre_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_content_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audio',
+            name='nombre_normalizado',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='Nombre normalizado'),
+        ),
+        migrations.AddField(
+            model_name='historicalaudio',
+            name='nombre_normalizado',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='Nombre normalizado'),
+        ),
+        migrations.AddField(
+            model_name='historicalpictograma',
+            name='nombre_normalizado',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='Nombre normalizado'),
+        ),
+        migrations.AddField(
+            model_name='pictograma',
+            name='nombre_normalizado',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='Nombre normalizado'),
+        ),
+        migrations.AddIndex(
+            model_name='audio',
+            index=models.Index(fields=['nombre_normalizado'], name='audio_nombre_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='pictograma',
+            index=models.Index(fields=['nombre_normalizado'], name='pictograma_nombre_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(backfill_normalized_names, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_content_name_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='reserved_storage',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -1,11 +1,41 @@
+import uuid
+import unicodedata
+
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.db import models
+from django.utils import timezone
 
 from simple_history.models import HistoricalRecords
 
 from .managers import UserManager
 
 
+# Estados del procesamiento en segundo plano del contenido (e.g. miniaturas)
+PROCESSING_STATUS_CHOICES = [
+    ('pendiente', 'Pendiente'),
+    ('procesando', 'Procesando'),
+    ('listo', 'Listo'),
+    ('error', 'Error'),
+]
+
+# Largo de nombre_normalizado; NFKD puede alargar el nombre original
+NORMALIZED_NAME_LENGTH = 50
+
+
+def normalize_name(value):
+    """
+    Nombre en minúsculas, sin tildes ni espacios repetidos, usado para 
+    buscar contenido sin distinguir mayúsculas ni acentos. Se recorta al 
+    largo de la columna, ya que la descomposición NFKD puede alargarlo 
+    (e.g. 'ﬁ' o '㎏').
+    """
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    value = ' '.join(value.lower().split())
+
+    return value[:NORMALIZED_NAME_LENGTH].rstrip()
+
+
 class User(AbstractBaseUser, PermissionsMixin):
     name = models.CharField(max_length=255, blank=True, default='')
     email = models.EmailField(max_length=254, unique=True)
@@ -35,13 +65,72 @@ class AccountActivationToken(models.Model):
     token = models.CharField(max_length=128, unique=True)
 
 
+class UserStorage(models.Model):
+    """
+    Contador persistente del almacenamiento usado por cada usuario (en bytes),
+    desglosado por tipo de contenido. Evita recorrer el disco en cada consulta.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name='storage'
+    )
+    used_storage = models.PositiveBigIntegerField(default=0)
+    reserved_storage = models.PositiveBigIntegerField(default=0)
+    pictograms_size = models.PositiveBigIntegerField(default=0)
+    sounds_size = models.PositiveBigIntegerField(default=0)
+    covers_size = models.PositiveBigIntegerField(default=0)
+    routines_size = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'User storage'
+        verbose_name_plural = 'User storage'
+
+    def __str__(self):
+        return f'Almacenamiento del usuario {self.user_id}'
+
+
+class MediaBlob(models.Model):
+    """
+    Archivo guardado una única vez según su contenido (hash SHA-256) y 
+    compartido por todos los pictogramas y audios que lo referencian.
+    """
+    hash = models.CharField(max_length=64, unique=True)
+    ruta = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Media blob'
+        verbose_name_plural = 'Media blobs'
+
+    def __str__(self):
+        return f'Blob {self.hash} ({self.ref_count} referencias)'
+
+
 class Pictograma(models.Model):
     nombre = models.CharField('Nombre', max_length=50)
+    nombre_normalizado = models.CharField(
+        'Nombre normalizado', 
+        max_length=NORMALIZED_NAME_LENGTH, 
+        blank=True, 
+        default='',
+        editable=False
+    )
     ruta = models.ImageField(
         'Ruta', 
         upload_to='',
         max_length=255
     )
+    miniaturas = models.JSONField('Miniaturas', default=dict, blank=True)
+    estado = models.CharField(
+        'Estado', 
+        max_length=20, 
+        choices=PROCESSING_STATUS_CHOICES, 
+        default='listo'
+    )
     fecha_subida = models.DateTimeField(auto_now_add=True)
     ultima_modificacion = models.DateTimeField(auto_now=True)
     es_precargado = models.BooleanField(default=False)
@@ -52,13 +141,45 @@ class Pictograma(models.Model):
     class Meta:
         verbose_name = 'Pictograma'
         verbose_name_plural = 'Pictogramas'
+        indexes = [
+            models.Index(
+                fields=['autor', 'ultima_modificacion'], 
+                name='pictograma_autor_mod_idx'
+            ),
+            models.Index(
+                fields=['ultima_modificacion', 'id'], 
+                name='pictograma_preloaded_idx',
+                condition=models.Q(es_precargado=True)
+            ),
+            models.Index(
+                fields=['nombre_normalizado'], 
+                name='pictograma_nombre_idx',
+                opclasses=['varchar_pattern_ops']
+            ),
+        ]
 
     def __str__(self):
         return f'Pictograma "{self.nombre}" subido por {self.autor.email}'
 
+    def save(self, *args, **kwargs):
+        self.nombre_normalizado = normalize_name(self.nombre)
+        update_fields = kwargs.get('update_fields')
+
+        if update_fields is not None and 'nombre' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'nombre_normalizado'}
+
+        super().save(*args, **kwargs)
+
 
 class Audio(models.Model):
     nombre = models.CharField('Nombre', max_length=50)
+    nombre_normalizado = models.CharField(
+        'Nombre normalizado', 
+        max_length=NORMALIZED_NAME_LENGTH, 
+        blank=True, 
+        default='',
+        editable=False
+    )
     ruta = models.FileField(
         'Ruta', 
         upload_to='', 
@@ -74,14 +195,41 @@ class Audio(models.Model):
     class Meta:
         verbose_name = 'Audio'
         verbose_name_plural = 'Audios'
+        indexes = [
+            models.Index(
+                fields=['autor', 'ultima_modificacion'], 
+                name='audio_autor_mod_idx'
+            ),
+            models.Index(
+                fields=['ultima_modificacion', 'id'], 
+                name='audio_preloaded_idx',
+                condition=models.Q(es_precargado=True)
+            ),
+            models.Index(
+                fields=['nombre_normalizado'], 
+                name='audio_nombre_idx',
+                opclasses=['varchar_pattern_ops']
+            ),
+        ]
 
     def __str__(self):
         return f'Audio "{self.nombre}" subido por {self.autor.email}'
+
+    def save(self, *args, **kwargs):
+        self.nombre_normalizado = normalize_name(self.nombre)
+        update_fields = kwargs.get('update_fields')
+
+        if update_fields is not None and 'nombre' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'nombre_normalizado'}
+
+        super().save(*args, **kwargs)
     
 
 class Rutina(models.Model):
     nombre = models.CharField('Nombre', max_length=50)
     json_rutina = models.TextField('JSON de la rutina', default="")
+    documento = models.JSONField('Documento de la rutina', null=True, blank=True)
+    version = models.PositiveIntegerField('Versión', default=1)
     url_portada = models.ImageField(
         'URL de la portada', 
         upload_to='',
@@ -90,6 +238,17 @@ class Rutina(models.Model):
         blank=True,
         default=""
     )
+    miniaturas = models.JSONField(
+        'Miniaturas de la portada', 
+        default=dict, 
+        blank=True
+    )
+    estado = models.CharField(
+        'Estado', 
+        max_length=20, 
+        choices=PROCESSING_STATUS_CHOICES, 
+        default='listo'
+    )
     fecha_creacion = models.DateTimeField(auto_now_add=True)
     ultima_modificacion = models.DateTimeField(auto_now=True)
 
@@ -99,6 +258,122 @@ class Rutina(models.Model):
     class Meta:
         verbose_name = 'Rutina'
         verbose_name_plural = 'Rutinas'
+        indexes = [
+            models.Index(
+                fields=['autor', 'ultima_modificacion'], 
+                name='rutina_autor_mod_idx'
+            ),
+        ]
 
     def __str__(self):
         return f'Rutina "{self.nombre}" creada por {self.autor.email}'
+
+
+class RoutineMediaLink(models.Model):
+    """
+    Pictograma o audio referenciado en el JSON de una rutina. Se extrae al
+    guardar la rutina para poder consultar dónde se usa cada contenido sin 
+    recorrer los documentos.
+    """
+    rutina = models.ForeignKey(
+        Rutina, 
+        on_delete=models.CASCADE, 
+        related_name='media_links'
+    )
+    pictograma = models.ForeignKey(
+        Pictograma, 
+        on_delete=models.CASCADE, 
+        null=True, 
+        blank=True, 
+        related_name='routine_links'
+    )
+    audio = models.ForeignKey(
+        Audio, 
+        on_delete=models.CASCADE, 
+        null=True, 
+        blank=True, 
+        related_name='routine_links'
+    )
+
+    class Meta:
+        verbose_name = 'Routine media link'
+        verbose_name_plural = 'Routine media links'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['rutina', 'pictograma'], 
+                name='unique_routine_pictogram_link'
+            ),
+            models.UniqueConstraint(
+                fields=['rutina', 'audio'], 
+                name='unique_routine_audio_link'
+            ),
+        ]
+
+    def __str__(self):
+        return f'Rutina {self.rutina_id} -> {self.pictograma_id or self.audio_id}'
+
+
+class ProcessingJob(models.Model):
+    """
+    Tarea en la cola de procesamiento en segundo plano, almacenada en la 
+    propia base de datos (no requiere un broker externo).
+    """
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=20, 
+        choices=PROCESSING_STATUS_CHOICES, 
+        default='pendiente'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Processing job'
+        verbose_name_plural = 'Processing jobs'
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return f'Tarea {self.kind} #{self.id} ({self.status})'
+
+
+class UploadSession(models.Model):
+    """
+    Subida reanudable por partes: el archivo se arma en disco a medida que
+    llegan las partes y, al finalizar, se entrega al flujo normal de creación.
+    """
+    TARGET_CHOICES = [
+        ('audio', 'Audio'),
+        ('portada', 'Portada de rutina'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User, 
+        on_delete=models.CASCADE, 
+        related_name='upload_sessions'
+    )
+    target = models.CharField(max_length=20, choices=TARGET_CHOICES)
+    nombre = models.CharField('Nombre', max_length=50)
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    # Bytes reservados en el almacenamiento del usuario hasta finalizarla
+    reserved_storage = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Upload session'
+        verbose_name_plural = 'Upload sessions'
+
+    def __str__(self):
+        return f'Subida {self.id} ({self.offset}/{self.size} bytes)'
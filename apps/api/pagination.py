@@ -0,0 +1,129 @@
+import json
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class ContentCursorPagination(BasePagination):
+    """
+    Paginación por cursor (keyset) de los listados de contenido, ordenados
+    del más reciente al más antiguo por (ultima_modificacion, id). El cursor
+    guarda ambos valores del último elemento de la página, por lo que no se
+    repiten ni se saltan elementos aunque se creen otros mientras se recorre.
+
+    Sin 'page_size' se entregan CONTENT_PAGE_SIZE elementos. Mientras
+    CONTENT_LEGACY_UNPAGINATED esté activo, una petición sin 'cursor' ni
+    'page_size' recibe la respuesta anterior (la lista completa) con el
+    encabezado 'Deprecation'; esa respuesta se eliminará.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering = ('-ultima_modificacion', '-id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+
+        if settings.CONTENT_LEGACY_UNPAGINATED and \
+                self.cursor_query_param not in params and \
+                self.page_size_query_param not in params:
+            return None
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(params.get(self.cursor_query_param))
+
+        if cursor is not None:
+            queryset = self.filter_after_cursor(queryset, *cursor)
+
+        # Un elemento extra indica si existe una página siguiente
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        return self.page
+
+    def filter_after_cursor(self, queryset, last_modified, last_id):
+        """
+        Elementos posteriores al cursor, expresados como comparación de filas
+        (ultima_modificacion, id) < (%s, %s) para que el motor recorra los
+        índices por (ultima_modificacion, id) desde el cursor. Django 4.2 no
+        tiene una expresión para comparar filas, por eso se usa extra().
+        """
+        connection = connections[queryset.db]
+        quote_name = connection.ops.quote_name
+        table = quote_name(queryset.model._meta.db_table)
+
+        return queryset.extra(
+            where=[
+                f'({table}.{quote_name("ultima_modificacion")}, '
+                f'{table}.{quote_name("id")}) < (%s, %s)'
+            ],
+            params=[
+                connection.ops.adapt_datetimefield_value(last_modified),
+                last_id,
+            ],
+        )
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param)
+
+        try:
+            page_size = int(page_size)
+        except (TypeError, ValueError):
+            return settings.CONTENT_PAGE_SIZE
+
+        return min(max(page_size, 1), settings.CONTENT_MAX_PAGE_SIZE)
+
+    def encode_cursor(self, instance):
+        position = [instance.ultima_modificacion.isoformat(), instance.id]
+        cursor = urlsafe_b64encode(json.dumps(position).encode('utf-8'))
+
+        return cursor.decode('ascii')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+
+        try:
+            last_modified, last_id = json.loads(urlsafe_b64decode(cursor))
+            return datetime.fromisoformat(last_modified), int(last_id)
+        except (TypeError, ValueError):
+            raise NotFound('Cursor inválido.')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+
+        return replace_query_param(
+            url,
+            self.cursor_query_param,
+            self.encode_cursor(self.page[-1])
+        )
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
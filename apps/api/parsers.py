@@ -0,0 +1,15 @@
+from rest_framework.parsers import JSONParser
+
+
+class JSONPatchParser(JSONParser):
+    """
+    Cuerpos JSON Patch (RFC 6902): una lista de operaciones.
+    """
+    media_type = 'application/json-patch+json'
+
+
+class MergePatchParser(JSONParser):
+    """
+    Cuerpos JSON Merge Patch (RFC 7396): un documento parcial.
+    """
+    media_type = 'application/merge-patch+json'
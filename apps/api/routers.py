@@ -13,9 +13,12 @@ from .views.viewsets import UserViewSet
 from .views.viewsets import PictogramaViewSet
 from .views.viewsets import AudioViewSet
 from .views.viewsets import RutinaViewSet
+from .views.viewsets import UploadSessionViewSet
 
 # Otras vistas
 from .views.api_views import UserStorageView
+from .views.api_views import RoutineCacheStatsView
+from .views.api_views import SyncView
 from .views.api_views import ContactFormView
 from .views.api_views import TermsAndConditionsView
 
@@ -26,6 +29,7 @@ router.register(r'pictogramas', PictogramaViewSet, basename='pictograma')
 router.register(r'audios', AudioViewSet, basename='audio')
 router.register(r'rutinas', RutinaViewSet, basename='rutina')
 router.register(r'usuarios', UserViewSet, basename='usuario')
+router.register(r'subidas', UploadSessionViewSet, basename='subida')
 
 urlpatterns = [
     path('api/login/', LoginView.as_view(), name='login'),
@@ -41,6 +45,12 @@ urlpatterns = [
         UserStorageView.as_view(), 
         name='user-storage',
     ),
+    path(
+        'api/routine-cache-stats/', 
+        RoutineCacheStatsView.as_view(), 
+        name='routine-cache-stats',
+    ),
+    path('api/sync/', SyncView.as_view(), name='sync'),
     path('api/contact/', ContactFormView.as_view(), name='contact'),
     path(
         'api/terms-and-conditions/', 
@@ -1,17 +1,27 @@
+import os
 import re
+import json
+import zipfile
+import mimetypes
 
+from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
 from rest_framework import serializers
+from rest_framework.exceptions import APIException
 from drf_recaptcha.fields import ReCaptchaV2Field
 
-from .models import User, Pictograma, Audio, Rutina
+from .models import User, Pictograma, Audio, Rutina, UploadSession
 
 from .utils import create_content
 from .utils import update_content
+from .utils import create_content_batch
+from .utils import import_routine_bundle
+from .utils import BUNDLE_MANIFEST, BUNDLE_MEDIA
 from .utils import create_routine
 from .utils import update_routine_instance
 from .utils import get_user_instance
+from .utils import get_derivative_urls
 
 from .validators import verify_email_complexity
 from .validators import verify_email_is_blacklisted
@@ -20,6 +30,10 @@ from .validators import use_default_password_validators
 from .validators import verify_file_type
 from .validators import verify_file_size
 from .validators import verify_content_name
+from .validators import verify_mime_type
+from .validators import verify_upload_size
+from .validators import verify_max_file_size
+from .validators import verify_remaining_storage
 from .validators import verify_value_length
 from .validators import verify_name_complexity
 
@@ -172,10 +186,16 @@ class UserSerializer(serializers.ModelSerializer):
 
 # OK
 class PictogramaSerializer(serializers.ModelSerializer):
+    miniaturas = serializers.SerializerMethodField()
     
     class Meta:
         model = Pictograma
-        fields = '__all__'
+        exclude = ['nombre_normalizado']
+
+    # ----- get_miniaturas -----
+    def get_miniaturas(self, instance):
+        request = self.context.get('request')
+        return get_derivative_urls(instance.miniaturas, request)
 
     # ----- validate_autor ----- OK
     def validate_autor(self, value):
@@ -250,7 +270,7 @@ class AudioSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Audio
-        fields = '__all__'
+        exclude = ['nombre_normalizado']
 
     # ----- validate_autor ----- OK
     def validate_autor(self, value):
@@ -322,10 +342,17 @@ class AudioSerializer(serializers.ModelSerializer):
     
 
 class RutinaSerializer(serializers.ModelSerializer):
+    miniaturas = serializers.SerializerMethodField()
     
     class Meta:
         model = Rutina
-        fields = '__all__'
+        # El documento se entrega en 'json_rutina' sólo al consultar una rutina
+        exclude = ['documento']
+
+    # ----- get_miniaturas -----
+    def get_miniaturas(self, instance):
+        request = self.context.get('request')
+        return get_derivative_urls(instance.miniaturas, request)
 
     # ----- validate_autor ----- OK
     def validate_autor(self, value):
@@ -392,3 +419,370 @@ class RutinaSerializer(serializers.ModelSerializer):
         model_instance.save()
 
         return model_instance
+
+
+# ----- Serializadores de lectura -----
+# Listan y consultan contenido sin la maquinaria de ModelSerializer (sin 
+# validaciones ni campos generados a partir del modelo). 'projection' son las
+# columnas que usan, para cargar sólo esas con .only().
+
+class SparseFieldsetSerializer(serializers.Serializer):
+    """
+    Serializador de lectura que puede entregar sólo algunos de sus campos 
+    (e.g. ?fields=id,nombre,ruta), cargando también sólo sus columnas.
+    """
+    projection = ()
+
+    # Columnas que siempre se cargan (el cursor de la paginación las usa)
+    required_columns = ('id', 'ultima_modificacion')
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def parse_fields(cls, value):
+        """
+        Retorna la lista de campos pedidos, o None si se piden todos.
+        """
+        fields = [name.strip() for name in (value or '').split(',') if name.strip()]
+
+        if not fields:
+            return None
+        
+        invalid_fields = [name for name in fields if name not in cls._declared_fields]
+
+        if invalid_fields:
+            msg = f'Campos inválidos: {", ".join(invalid_fields)}.'
+            raise serializers.ValidationError(msg)
+        
+        return fields
+    
+    @classmethod
+    def get_projection(cls, fields=None):
+        if fields is None:
+            return cls.projection
+        
+        return tuple(
+            column for column in cls.projection 
+            if column in fields or column in cls.required_columns
+        )
+    
+    @classmethod
+    def narrow(cls, data, fields=None):
+        """
+        Deja sólo los campos pedidos en datos ya serializados (e.g. el 
+        catálogo precargado en caché), en el orden del serializador.
+        """
+        if fields is None:
+            return data
+        
+        names = [name for name in cls._declared_fields if name in fields]
+
+        return [{name: item[name] for name in names} for item in data]
+
+
+class PictogramaReadSerializer(SparseFieldsetSerializer):
+    projection = (
+        'id', 
+        'nombre', 
+        'ruta', 
+        'miniaturas', 
+        'estado', 
+        'fecha_subida', 
+        'ultima_modificacion', 
+        'es_precargado', 
+        'autor',
+    )
+
+    id = serializers.IntegerField(read_only=True)
+    miniaturas = serializers.SerializerMethodField()
+    nombre = serializers.CharField(read_only=True)
+    ruta = serializers.ImageField(read_only=True)
+    estado = serializers.CharField(read_only=True)
+    fecha_subida = serializers.DateTimeField(read_only=True)
+    ultima_modificacion = serializers.DateTimeField(read_only=True)
+    es_precargado = serializers.BooleanField(read_only=True)
+    autor = serializers.IntegerField(source='autor_id', read_only=True)
+
+    # ----- get_miniaturas -----
+    def get_miniaturas(self, instance):
+        request = self.context.get('request')
+        return get_derivative_urls(instance.miniaturas, request)
+
+
+class AudioReadSerializer(SparseFieldsetSerializer):
+    projection = (
+        'id', 
+        'nombre', 
+        'ruta', 
+        'fecha_subida', 
+        'ultima_modificacion', 
+        'es_precargado', 
+        'autor',
+    )
+
+    id = serializers.IntegerField(read_only=True)
+    nombre = serializers.CharField(read_only=True)
+    ruta = serializers.FileField(read_only=True)
+    fecha_subida = serializers.DateTimeField(read_only=True)
+    ultima_modificacion = serializers.DateTimeField(read_only=True)
+    es_precargado = serializers.BooleanField(read_only=True)
+    autor = serializers.IntegerField(source='autor_id', read_only=True)
+
+
+class RutinaReadSerializer(SparseFieldsetSerializer):
+    # Sin 'documento', que se entrega sólo al consultar una rutina
+    projection = (
+        'id', 
+        'nombre', 
+        'json_rutina', 
+        'version', 
+        'url_portada', 
+        'miniaturas', 
+        'estado', 
+        'fecha_creacion', 
+        'ultima_modificacion', 
+        'autor',
+    )
+
+    id = serializers.IntegerField(read_only=True)
+    miniaturas = serializers.SerializerMethodField()
+    nombre = serializers.CharField(read_only=True)
+    json_rutina = serializers.CharField(read_only=True)
+    version = serializers.IntegerField(read_only=True)
+    url_portada = serializers.ImageField(read_only=True)
+    estado = serializers.CharField(read_only=True)
+    fecha_creacion = serializers.DateTimeField(read_only=True)
+    ultima_modificacion = serializers.DateTimeField(read_only=True)
+    autor = serializers.IntegerField(source='autor_id', read_only=True)
+
+    # ----- get_miniaturas -----
+    def get_miniaturas(self, instance):
+        request = self.context.get('request')
+        return get_derivative_urls(instance.miniaturas, request)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    # Tipo de contenido validado para cada destino de la subida
+    TARGET_CONTENT_TYPES = {
+        'audio': 'Audio',
+        'portada': 'Rutina',
+    }
+
+    class Meta:
+        model = UploadSession
+        fields = '__all__'
+        read_only_fields = [
+            'user', 
+            'offset', 
+            'reserved_storage', 
+            'created_at', 
+            'updated_at',
+        ]
+
+    # ----- validate_nombre -----
+    def validate_nombre(self, value):
+        verify_content_name(value)
+
+        return value
+
+    # ----- validate -----
+    def validate(self, attrs):
+        user = self.context['request'].user
+        content_type = self.TARGET_CONTENT_TYPES[attrs['target']]
+
+        # Se valida antes de recibir las partes para no subir archivos inútiles
+        verify_mime_type(attrs['content_type'], content_type)
+        verify_upload_size(attrs['size'], user)
+
+        return attrs
+
+
+class ContentBatchSerializer(serializers.Serializer):
+    """
+    Subida en lote de pictogramas o audios. Cada archivo se valida por 
+    separado: los inválidos se informan en 'errors' sin impedir que se
+    creen los demás. El espacio disponible se verifica una sola vez, 
+    para el total del lote.
+    """
+    files = serializers.ListField(
+        child=serializers.FileField(), 
+        allow_empty=False, 
+        max_length=settings.BATCH_UPLOAD_MAX_FILES
+    )
+    names = serializers.ListField(
+        child=serializers.CharField(allow_blank=True), 
+        required=False
+    )
+    autor = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+
+    def __init__(self, *args, content_model=None, content_folder=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.content_model = content_model
+        self.content_folder = content_folder
+
+    # ----- validate_autor -----
+    def validate_autor(self, value):
+        if not value.is_active:
+            raise serializers.ValidationError('Usuario inactivo.')
+
+        return value
+
+    # ----- validate -----
+    def validate(self, attrs):
+        model_name = self.content_model._meta.verbose_name
+        names = attrs.get('names', [])
+        items = []
+        errors = []
+
+        for index, file in enumerate(attrs['files']):
+            # Sin nombre explícito, se usa el del archivo
+            if index < len(names) and names[index]:
+                name = names[index]
+            else:
+                name, _ = os.path.splitext(file.name)
+
+            try:
+                verify_content_name(name)
+                verify_file_type(file, model_name)
+                verify_max_file_size(file.size)
+            except APIException as e:
+                errors.append({
+                    'index': index, 
+                    'nombre': name, 
+                    'status': e.status_code, 
+                    'errors': e.detail
+                })
+                continue
+
+            items.append({'index': index, 'nombre': name, 'ruta': file})
+
+        if items:
+            verify_remaining_storage(
+                sum(item['ruta'].size for item in items), 
+                attrs['autor']
+            )
+
+        attrs['items'] = items
+        attrs['errors'] = errors
+
+        return attrs
+
+    # ----- CREATE -----
+    def create(self, validated_data):
+        if not validated_data['items']:
+            return []
+        
+        return create_content_batch(
+            content_model=self.content_model,
+            user_model=User,
+            content_folder=self.content_folder,
+            validated_data={
+                **validated_data, 
+                'autor': validated_data['autor'].id
+            }
+        )
+
+
+class RoutineBundleSerializer(serializers.Serializer):
+    """
+    Importación de una rutina exportada como ZIP. Valida el manifiesto y 
+    cada archivo del paquete antes de crear cualquier contenido.
+    """
+    file = serializers.FileField()
+    autor = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+
+    # ----- validate_autor -----
+    def validate_autor(self, value):
+        if not value.is_active:
+            raise serializers.ValidationError('Usuario inactivo.')
+
+        return value
+    
+    # ----- validate -----
+    def validate(self, attrs):
+        try:
+            archive = zipfile.ZipFile(attrs['file'])
+            
+            with archive.open(BUNDLE_MANIFEST) as f:
+                manifest = json.load(f)
+        except (zipfile.BadZipFile, KeyError, ValueError):
+            raise serializers.ValidationError('Paquete de rutina inválido.')
+        
+        if not isinstance(manifest, dict) or 'json_rutina' not in manifest:
+            raise serializers.ValidationError('Paquete de rutina inválido.')
+        
+        verify_content_name(manifest.get('nombre') or '')
+        total_size = 0
+
+        for key, (_, content_model, _) in BUNDLE_MEDIA.items():
+            entries = []
+
+            for entry in manifest.get(key) or []:
+                # Los archivos que no se pudieron exportar se omiten
+                if not entry.get('archivo'):
+                    continue
+
+                verify_content_name(entry.get('nombre') or '')
+                entry['content_type'] = self.verify_bundle_file(
+                    archive, 
+                    entry['archivo'], 
+                    content_model._meta.verbose_name
+                )
+                total_size += archive.getinfo(entry['archivo']).file_size
+                entries.append(entry)
+
+            manifest[key] = entries
+
+        cover = manifest.get('portada')
+
+        if cover and cover.get('archivo'):
+            cover['content_type'] = self.verify_bundle_file(
+                archive, 
+                cover['archivo'], 
+                'Rutina'
+            )
+            total_size += archive.getinfo(cover['archivo']).file_size
+        else:
+            manifest['portada'] = None
+
+        if total_size:
+            verify_remaining_storage(total_size, attrs['autor'])
+
+        attrs['archive'] = archive
+        attrs['manifest'] = manifest
+        attrs['total_size'] = total_size
+
+        return attrs
+    
+    def verify_bundle_file(self, archive, name, model_name):
+        try:
+            info = archive.getinfo(name)
+        except KeyError:
+            msg = f'El archivo {name} no está en el paquete.'
+            raise serializers.ValidationError(msg)
+        
+        mime_type, _ = mimetypes.guess_type(name)
+
+        # mimetypes usa el nombre antiguo para los archivos WAV
+        if mime_type == 'audio/x-wav':
+            mime_type = 'audio/wav'
+
+        verify_mime_type(mime_type, model_name)
+        verify_max_file_size(info.file_size)
+
+        return mime_type
+
+    # ----- CREATE -----
+    def create(self, validated_data):
+        return import_routine_bundle(
+            user_model=User,
+            validated_data={
+                **validated_data, 
+                'autor': validated_data['autor'].id
+            }
+        )
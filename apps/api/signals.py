@@ -1,14 +1,16 @@
 import os
 
 from django.core.mail import EmailMultiAlternatives
-from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.utils.crypto import get_random_string
 
 from django_rest_passwordreset.signals import reset_password_token_created
 
-from .models import User, AccountActivationToken
+from .models import User, AccountActivationToken, Pictograma, Audio
+from .utils import bump_preloaded_catalog
 
 
 @receiver(post_save, sender=User)
@@ -219,3 +221,13 @@ def send_user_signout_email(sender, instance, **kwargs):
         
         msg.attach_alternative(email_html_message, "text/html")
         msg.send()
+
+
+@receiver(post_save, sender=Pictograma)
+@receiver(post_save, sender=Audio)
+@receiver(post_delete, sender=Pictograma)
+@receiver(post_delete, sender=Audio)
+def preloaded_content_changed(sender, instance, **kwargs):
+    # Invalida el catálogo precargado en caché una vez confirmado el cambio
+    if instance.es_precargado:
+        transaction.on_commit(lambda: bump_preloaded_catalog(sender))
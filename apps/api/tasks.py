@@ -0,0 +1,122 @@
+"""
+Cola de tareas en segundo plano respaldada por la base de datos.
+
+Las tareas se registran con enqueue_job() y las ejecuta el comando
+run_worker, que reclama cada tarea con un UPDATE condicional para que
+varios procesos puedan trabajar en paralelo sin ejecutar dos veces la misma.
+"""
+
+import traceback
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ProcessingJob
+
+
+# Funciones que ejecutan cada tipo de tarea, registradas con @job_handler
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+    def register(handler):
+        JOB_HANDLERS[kind] = handler
+        return handler
+
+    return register
+
+
+def enqueue_job(kind, payload):
+    """
+    Agrega una tarea a la cola. Si se llama dentro de una transacción, la
+    tarea sólo será visible para los workers una vez confirmada.
+    """
+    return ProcessingJob.objects.create(kind=kind, payload=payload)
+
+
+def claim_job(worker_id):
+    """
+    Reclama la siguiente tarea pendiente para el worker y la retorna, o None
+    si no hay tareas disponibles.
+    """
+    now = timezone.now()
+    candidates = ProcessingJob.objects.filter(
+        status='pendiente',
+        run_after__lte=now
+    ).order_by('run_after', 'id').values_list('id', flat=True)[:10]
+
+    for job_id in candidates:
+        claimed = ProcessingJob.objects.filter(
+            id=job_id,
+            status='pendiente'
+        ).update(
+            status='procesando',
+            attempts=F('attempts') + 1,
+            locked_by=worker_id,
+            locked_at=now,
+            updated_at=now,
+        )
+
+        if claimed:
+            return ProcessingJob.objects.get(id=job_id)
+
+    return None
+
+
+def run_job(job):
+    """
+    Ejecuta la tarea. Si falla, se reintenta más tarde hasta agotar los
+    intentos (PROCESSING_JOB_MAX_ATTEMPTS); luego queda en estado 'error'.
+    """
+    handler = JOB_HANDLERS.get(job.kind)
+
+    try:
+        if handler is None:
+            raise LookupError(f'Tipo de tarea desconocido: {job.kind}')
+
+        handler(job)
+
+        job.status = 'listo'
+        job.last_error = ''
+
+    except Exception:
+        job.last_error = traceback.format_exc()
+
+        if job.attempts >= settings.PROCESSING_JOB_MAX_ATTEMPTS:
+            job.status = 'error'
+        else:
+            job.status = 'pendiente'
+            job.run_after = timezone.now() + timedelta(minutes=job.attempts)
+
+    job.locked_by = ''
+    job.locked_at = None
+    job.save(update_fields=[
+        'status',
+        'last_error',
+        'run_after',
+        'locked_by',
+        'locked_at',
+        'updated_at',
+    ])
+
+    return job
+
+
+def requeue_stale_jobs():
+    """
+    Devuelve a la cola las tareas cuyo worker dejó de responder.
+    """
+    timeout = timedelta(seconds=settings.PROCESSING_JOB_TIMEOUT)
+
+    return ProcessingJob.objects.filter(
+        status='procesando',
+        locked_at__lt=timezone.now() - timeout
+    ).update(
+        status='pendiente',
+        locked_by='',
+        locked_at=None,
+        updated_at=timezone.now()
+    )
@@ -1,3 +1,224 @@
+from unittest import skipUnless
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework.test import APIClient
+
+from apps.api.models import User, Pictograma, Audio, Rutina
+
+
+def create_user(email, is_staff=False):
+    user = User.objects.create_user(email=email, password='clave')
+    user.is_active = True
+    user.is_staff = is_staff
+    user.save()
+
+    return user
+
+
+def create_contents(model, autor, total, es_precargado=False):
+    extension = 'png' if model is Pictograma else 'mp3'
+
+    model.objects.bulk_create(
+        model(
+            nombre=f'{autor.id}-{i}',
+            ruta=f'user_content/{autor.id}/{i}.{extension}',
+            autor=autor,
+            es_precargado=es_precargado,
+        )
+        for i in range(total)
+    )
+
+
+def create_routines(autor, total):
+    Rutina.objects.bulk_create(
+        Rutina(
+            nombre=f'{autor.id}-{i}',
+            json_rutina=f'user_content/{autor.id}/routines/{i}.json',
+            url_portada=f'user_content/{autor.id}/covers/{i}.png',
+            autor=autor,
+        )
+        for i in range(total)
+    )
+
+
+class ContentListingQueryCountTests(TestCase):
+    """
+    La cantidad de consultas de un listado no debe crecer con la cantidad de
+    pictogramas, audios o rutinas que entrega.
+    """
+
+    LISTINGS = (
+        '/pictogramas/', 
+        '/audios/', 
+        '/rutinas/',
+    )
+    PARAMS = (
+        '', 
+        '?page_size=100', 
+        '?fields=id,nombre',
+    )
+
+    def setUp(self):
+        self.staff = create_user('staff@picto.cl', is_staff=True)
+        self.user = create_user('usuario@picto.cl')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_listing_content(self, total):
+        for model in (Pictograma, Audio):
+            create_contents(model, self.staff, total, es_precargado=True)
+            create_contents(model, self.user, total)
+
+        create_routines(self.user, total)
+
+    def get_query_counts(self):
+        counts = {}
+
+        for url in self.LISTINGS:
+            for params in self.PARAMS:
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(url + params)
+
+                self.assertEqual(response.status_code, 200)
+                counts[url + params] = len(context.captured_queries)
+
+        return counts
+
+    def test_query_count_does_not_grow(self):
+        self.create_listing_content(1)
+        counts = self.get_query_counts()
+
+        self.create_listing_content(50)
+
+        for url, count in counts.items():
+            with self.subTest(url=url), self.assertNumQueries(count):
+                response = self.client.get(url)
+
+            self.assertEqual(response.status_code, 200)
+
+
+class ContentCursorPaginationTests(TestCase):
+    """
+    Los listados se paginan por defecto y el cursor recorre todo el contenido
+    visible sin repetir ni saltar elementos, aunque compartan la fecha de
+    modificación.
+    """
+
+    def setUp(self):
+        staff = create_user('staff@picto.cl', is_staff=True)
+        self.user = create_user('usuario@picto.cl')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        create_contents(Pictograma, staff, 7, es_precargado=True)
+        create_contents(Pictograma, self.user, 6)
+
+        # La mitad comparte la fecha, para que el desempate sea por id
+        pictogramas = Pictograma.objects.order_by('id')
+        same = pictogramas.first().ultima_modificacion
+        Pictograma.objects.filter(
+            id__in=list(pictogramas.values_list('id', flat=True)[::2])
+        ).update(ultima_modificacion=same)
+
+    def test_listing_is_paginated_by_default(self):
+        with self.settings(CONTENT_PAGE_SIZE=5):
+            response = self.client.get('/pictogramas/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_cursor_walks_every_content(self):
+        expected = Pictograma.objects.order_by(
+            '-ultima_modificacion', '-id'
+        ).values_list('id', flat=True)
+
+        ids = []
+        url = '/pictogramas/?page_size=4'
+
+        # Si el cursor no avanza, se corta al pasar del total
+        while url and len(ids) <= len(expected):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            ids += [content['id'] for content in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(ids, list(expected))
+
+    def test_legacy_unpaginated_listing(self):
+        with self.settings(CONTENT_LEGACY_UNPAGINATED=True):
+            response = self.client.get('/pictogramas/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 13)
+        self.assertEqual(response['Deprecation'], 'true')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Sólo en PostgreSQL')
+class ContentListingPlanTests(TestCase):
+    """
+    El listado de un usuario (contenido precargado más el propio) debe usar
+    los índices parciales y por autor, y no recorrer la tabla completa.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        staff = create_user('staff@picto.cl', is_staff=True)
+        cls.user = create_user('usuario@picto.cl')
+
+        for model in (Pictograma, Audio):
+            create_contents(model, staff, 50, es_precargado=True)
+            create_contents(model, cls.user, 30)
+
+            # Contenido de otros usuarios, que el listado no debe leer
+            others = User.objects.bulk_create(
+                User(email=f'{model.__name__.lower()}{i}@picto.cl')
+                for i in range(40)
+            )
+
+            for other in others:
+                create_contents(model, other, 250)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def get_listing_plans(self, url, model):
+        """
+        Retorna el plan (EXPLAIN) de cada consulta a la tabla del contenido
+        que hace el listado.
+        """
+        table = f'"{model._meta.db_table}"'
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+
+        plans = []
+
+        with connection.cursor() as cursor:
+            for query in context.captured_queries:
+                if not query['sql'].startswith('SELECT') or table not in query['sql']:
+                    continue
+
+                cursor.execute(f'EXPLAIN {query["sql"]}')
+                plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+
+        return plans
+
+    def test_listing_uses_indexes(self):
+        for url, model in (('/pictogramas/', Pictograma), ('/audios/', Audio)):
+            for params in ('', '?page_size=20'):
+                with self.subTest(url=url + params):
+                    plans = self.get_listing_plans(url + params, model)
+
+                    self.assertTrue(plans)
 
-# Create your tests here.
+                    for plan in plans:
+                        self.assertNotIn('Seq Scan', plan)
@@ -4,13 +4,86 @@ Utilidades varias, separadas para una mejor lectura y debugging del código.
 
 import os
 import re
+import copy
 import json
+import errno
+import logging
+import time
+import uuid
+import heapq
+import base64
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile, TemporaryUploadedFile
+from django.db import connection, transaction
+from django.db.models import F, Q, Value, Count, Max, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
-from datetime import datetime
+from rest_framework import exceptions, status
 
-from django.conf import settings
+from PIL import Image
+
+from simple_history.utils import bulk_create_with_history
+
+from .models import UserStorage, MediaBlob, UploadSession, ProcessingJob
+from .models import Pictograma, Audio, Rutina, RoutineMediaLink
+from .models import normalize_name
+from .tasks import enqueue_job, job_handler
+
+
+logger = logging.getLogger(__name__)
+
+# Campo del contador de almacenamiento asociado a cada carpeta de contenido
+STORAGE_FIELDS = {
+    'pictograms': 'pictograms_size',
+    'sounds': 'sounds_size',
+    'covers': 'covers_size',
+    'routines': 'routines_size',
+}
+
+# Carpeta de contenido asociada a cada modelo con archivo en 'ruta'
+CONTENT_FOLDERS = {
+    'Pictograma': 'pictograms',
+    'Audio': 'sounds',
+}
 
-from rest_framework import exceptions
+# Prefijo de los archivos temporales creados durante una escritura atómica
+TEMP_FILE_PREFIX = '.tmp_'
+
+# Tamaño de cada lectura al copiar archivos por partes
+READ_SIZE = 64 * 1024
+
+# Carpetas de contenido que se deduplican en el almacenamiento por contenido
+CONTENT_ADDRESSED_FOLDERS = ('pictograms', 'sounds')
+
+# Campo de imagen a partir del cual se generan las miniaturas de cada modelo
+DERIVATIVE_SOURCES = {
+    'Pictograma': 'ruta',
+    'Rutina': 'url_portada',
+}
+
+# Formatos de las miniaturas (WebP, con PNG como alternativa)
+DERIVATIVE_FORMATS = {
+    'webp': 'WEBP',
+    'png': 'PNG',
+}
 
 
 def get_queryset_by_user_type(model, request):
@@ -32,9 +105,14 @@ def get_queryset_by_user_type(model, request):
                 queryset = model.objects.filter(es_precargado=True)
             
             else:
-                preloaded_content = model.objects.filter(es_precargado=True)
-                user_content = model.objects.filter(autor=user.id)
-                queryset = preloaded_content | user_content
+                # Un OR entre ambas condiciones recorre la tabla completa en 
+                # PostgreSQL; la unión usa el índice parcial del contenido 
+                # precargado y el índice (autor, ultima_modificacion), y 
+                # sigue siendo una consulta que se puede filtrar y paginar
+                visible_ids = model.objects.filter(es_precargado=True) \
+                    .values('id') \
+                    .union(model.objects.filter(autor=user.id).values('id'))
+                queryset = model.objects.filter(id__in=visible_ids)
         
         return queryset
 
@@ -42,28 +120,216 @@ def get_queryset_by_user_type(model, request):
         raise exceptions.PermissionDenied('Acceso denegado.')
     
 
-def get_used_storage(user_id):
+def scan_storage_folder(user_id):
     '''
-    Devuelve el almacenamiento de cada usuario en bytes.
+    Recorre con os.scandir la carpeta del usuario y devuelve una tupla con:
+
+    - El desglose de su almacenamiento en bytes (total y por tipo de contenido).
+    - Las rutas relativas (a MEDIA_ROOT) de todos sus archivos.
+
+    No consulta la base de datos, por lo que puede ejecutarse en otro proceso.
     '''
     media_root = settings.MEDIA_ROOT
-    user_folder = f'user_content/{user_id}/'
-    storage_path = os.path.join(media_root, user_folder)
-    total_size = 0
+    storage_path = os.path.join(media_root, 'user_content', str(user_id))
+    breakdown = dict.fromkeys(['used_storage', *STORAGE_FIELDS.values()], 0)
+    files = []
+    pending = [(storage_path, None)]
 
+    while pending:
+        dirpath, content_field = pending.pop()
+
+        try:
+            entries = os.scandir(dirpath)
+        except FileNotFoundError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Las subcarpetas heredan el tipo de contenido de su raíz
+                    if dirpath == storage_path:
+                        entry_field = STORAGE_FIELDS.get(entry.name)
+                    else:
+                        entry_field = content_field
+
+                    pending.append((entry.path, entry_field))
+
+                elif entry.is_file():
+                    # Omite escrituras atómicas en curso
+                    if entry.name.startswith(TEMP_FILE_PREFIX):
+                        continue
+
+                    size = entry.stat().st_size
+                    breakdown['used_storage'] += size
+
+                    if content_field:
+                        breakdown[content_field] += size
+
+                    files.append(os.path.relpath(entry.path, media_root))
+
+    return breakdown, files
+
+
+def compute_storage_breakdown(user_id):
+    '''
+    Devuelve el almacenamiento en disco del usuario en bytes, tanto el total 
+    como el desglose por tipo de contenido.
+
+    NOTA: Es una operación costosa; sólo se usa para inicializar o corregir
+    el contador persistente (ver get_storage_ledger).
+    '''
     try:
-        for dirpath, dirnames, filenames in os.walk(storage_path):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                total_size += os.path.getsize(filepath)
+        breakdown, _ = scan_storage_folder(user_id)
 
-        return total_size
+        return breakdown
     
     except OSError as e:
-        print(f"Error en get_used_storage(): {e.strerror}")
+        print(f"Error en compute_storage_breakdown(): {e.strerror}")
         raise exceptions.ValidationError('Error en el servidor.')
 
 
+def get_storage_ledger(user_id):
+    '''
+    Devuelve el contador de almacenamiento del usuario. Si aún no existe,
+    se inicializa una única vez a partir del contenido en disco.
+    '''
+    ledger, _ = get_or_seed_storage_ledger(user_id)
+
+    return ledger
+
+
+def get_or_seed_storage_ledger(user_id):
+    try:
+        return UserStorage.objects.get(user_id=user_id), False
+    except UserStorage.DoesNotExist:
+        breakdown = compute_storage_breakdown(user_id)
+
+        return UserStorage.objects.get_or_create(
+            user_id=user_id, 
+            defaults=breakdown
+        )
+
+
+def get_used_storage(user_id):
+    '''
+    Devuelve el almacenamiento de cada usuario en bytes.
+    '''
+    return get_storage_ledger(user_id).used_storage
+
+
+def update_used_storage(user, content_folder, delta):
+    '''
+    Suma (o resta, si delta es negativo) bytes al contador de almacenamiento
+    del usuario y al de la carpeta de contenido correspondiente.
+
+    El contenido precargado (staff) no consume almacenamiento del usuario.
+    Debe llamarse dentro de la misma transacción que modifica la instancia.
+    '''
+    if user.is_staff or not delta:
+        return
+
+    _, seeded = get_or_seed_storage_ledger(user.id)
+
+    if seeded:
+        # El contador recién inicializado ya refleja el estado del disco
+        return
+    
+    values = {
+        'used_storage': Greatest(F('used_storage') + delta, Value(0)),
+        'updated_at': timezone.now(),
+    }
+    content_field = STORAGE_FIELDS.get(content_folder)
+
+    if content_field:
+        values[content_field] = Greatest(F(content_field) + delta, Value(0))
+
+    UserStorage.objects.filter(user_id=user.id).update(**values)
+
+
+class StorageReservation:
+    '''
+    Reserva atómica de almacenamiento para una subida en curso.
+
+    Al entrar, descuenta los bytes del espacio disponible del usuario con un
+    único UPDATE condicional (sólo se aplica si aún hay espacio), por lo que
+    dos subidas paralelas no pueden superar el límite. Se confirma con
+    commit() dentro de la transacción que crea el contenido y, si no se
+    confirma, se libera al salir del bloque.
+
+    Uso:
+        with StorageReservation(user, file.size) as reservation:
+            ...
+            reservation.commit()
+    '''
+
+    def __init__(self, user, size):
+        self.user = user
+        self.size = 0 if user.is_staff else max(0, size or 0)
+        self.is_active = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        if not self.size:
+            return
+        
+        get_storage_ledger(self.user.id)
+
+        available = self.user.storage_limit - self.size
+        reserved = UserStorage.objects.annotate(
+            total=F('used_storage') + F('reserved_storage')
+        ).filter(
+            user_id=self.user.id, 
+            total__lt=available
+        ).update(
+            reserved_storage=F('reserved_storage') + self.size
+        )
+
+        if not reserved:
+            msg = 'No hay espacio suficiente para almacenar este archivo.'
+            raise exceptions.ValidationError(msg)
+        
+        self.is_active = True
+
+    def commit(self):
+        '''
+        Libera la reserva junto con la transacción que registra el contenido
+        (cuyo tamaño real ya fue sumado por update_used_storage).
+        '''
+        if not self.is_active:
+            return
+        
+        self._discount()
+        transaction.on_commit(self._deactivate)
+
+    def release(self):
+        if not self.is_active:
+            return
+        
+        self._discount()
+        self._deactivate()
+
+    def _discount(self):
+        UserStorage.objects.filter(user_id=self.user.id).update(
+            reserved_storage=Greatest(
+                F('reserved_storage') - self.size, 
+                Value(0)
+            )
+        )
+
+    def _deactivate(self):
+        self.is_active = False
+
+
+def get_upload_size(file):
+    return getattr(file, 'size', 0) if file else 0
+
+
 def get_user_instance(user_id, user_model):
     try:
         user = user_model.objects.get(pk=user_id)
@@ -165,6 +431,7 @@ def create_content_instance(
     return content
 
 
+@transaction.atomic
 def create_content(content_model, user_model, content_folder, validated_data):
     """
     Función matriz que genera el contenido (pictograma o sonido)
@@ -198,6 +465,14 @@ def create_content(content_model, user_model, content_folder, validated_data):
             relative_path=relative_path
         )
 
+        # Confirma la reserva de almacenamiento de la subida, si la hay
+        reservation = validated_data.get('reservation')
+
+        if reservation:
+            reservation.commit()
+
+        schedule_media_processing(content_instance)
+
         return content_instance
     
     except OSError as e:
@@ -214,26 +489,98 @@ def remove_instance_file(instance):
             raise exceptions.NotFound("Archivo no encontrado o ruta errónea.")
         
         file.close()
-        
-        os.remove(file_path)
+
+        file_size = os.path.getsize(file_path)
+
+        # Un blob compartido sólo se elimina al perder su última referencia
+        if is_blob_path(file.name):
+            release_blob(file.name)
+        else:
+            os.remove(file_path)
+            remove_derivatives(file.name)
+
+        content_folder = CONTENT_FOLDERS.get(instance._meta.verbose_name)
+        update_used_storage(instance.autor, content_folder, -file_size)
 
     except OSError as e:
         print(f"Error en remove_instance_file(): {e.strerror}") # debug
         raise exceptions.ValidationError('Error en el servidor.')
 
 
+def set_file_permissions(file_path):
+    permissions = settings.FILE_UPLOAD_PERMISSIONS
+
+    if permissions is not None:
+        os.chmod(file_path, permissions)
+
+
+@contextmanager
+def atomic_write(file_path, mode='wb'):
+    """
+    Escribe un archivo de forma atómica: el contenido va a un archivo temporal
+    en la misma carpeta, que reemplaza al destino sólo cuando la escritura
+    termina. Si algo falla, nunca queda un archivo a medio escribir.
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path), 
+        prefix=TEMP_FILE_PREFIX
+    )
+
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+
+        set_file_permissions(temp_path)
+        os.replace(temp_path, file_path)
+
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+
+def write_uploaded_file(file, file_path):
+    """
+    Guarda el archivo subido en file_path sin cargarlo completo en memoria.
+
+    Si Django ya lo almacenó en un archivo temporal (TemporaryUploadedFile),
+    éste se mueve en vez de copiarse. En otro caso (o si el temporal está en
+    otro sistema de archivos) se copia por partes con file.chunks().
+    """
+    if hasattr(file, 'temporary_file_path'):
+        temp_path = file.temporary_file_path()
+
+        try:
+            set_file_permissions(temp_path)
+            os.replace(temp_path, file_path)
+            return
+        
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    with atomic_write(file_path) as f:
+        for chunk in file.chunks():
+            f.write(chunk)
+
+
 def save_file(user, name, file, content_folder):
     try:
-        filename = filename_generator(name, file)
+        if is_content_addressed(content_folder):
+            file_path = save_blob(file)
 
-        file_path = path_generator(
-            user_instance=user, 
-            content_type=content_folder, 
-            filename=filename
-        )
+        else:
+            filename = filename_generator(name, file)
 
-        with open(file_path, 'wb') as f:
-            f.write(file.read())
+            file_path = path_generator(
+                user_instance=user, 
+                content_type=content_folder, 
+                filename=filename
+            )
+
+            write_uploaded_file(file, file_path)
+
+        update_used_storage(user, content_folder, os.path.getsize(file_path))
 
         return file_path
     except OSError as e:
@@ -242,6 +589,10 @@ def save_file(user, name, file, content_folder):
 
 
 def rename_file(instance, new_name):
+    # El nombre de un blob depende de su contenido, no del nombre de la instancia
+    if is_blob_path(instance.ruta.name):
+        return instance.ruta.name
+
     try:
         instance.ruta.close()
 
@@ -255,6 +606,13 @@ def rename_file(instance, new_name):
 
         relative_path = os.path.relpath(new_path, settings.MEDIA_ROOT)
 
+        if hasattr(instance, 'miniaturas'):
+            instance.miniaturas = relocate_derivatives(
+                instance.miniaturas, 
+                instance.ruta.name, 
+                relative_path
+            )
+
         return relative_path
 
     except OSError as e:
@@ -262,6 +620,7 @@ def rename_file(instance, new_name):
         raise exceptions.ValidationError('Error en el servidor.')
 
 
+@transaction.atomic
 def update_content(
         user_model, 
         content_folder, 
@@ -348,6 +707,10 @@ def update_content(
             print('No se han realizado cambios al contenido.') # debug
             pass
 
+        # Regenera las miniaturas si cambió el archivo
+        if new_content_file != old_content_file:
+            schedule_media_processing(instance)
+
         return instance
     
     except OSError as e:
@@ -383,9 +746,15 @@ def create_json_file(user_instance, content_name, content_json):
             filename=filename
         )
 
-        with open(file_path, 'w') as file:
+        with atomic_write(file_path, 'w') as file:
             json.dump(content_json, file, indent=4)
 
+        update_used_storage(
+            user_instance, 
+            'routines', 
+            os.path.getsize(file_path)
+        )
+
         # Establece la ruta relativa a guardar en la instancia
         relative_path = os.path.relpath(file_path, settings.MEDIA_ROOT)
 
@@ -403,11 +772,12 @@ def rename_json_file(instance, new_name):
         raise exceptions.NotFound('Archivo no encontrado.')
     
     else:
+        routine_cache.invalidate(rel_path)
+
         try:
             old_path = os.path.join(settings.MEDIA_ROOT + '/' + rel_path)
 
             if os.path.exists(old_path):
-                rel_path.close()
                 _, extension = os.path.splitext(old_path)
 
             new_filename = json_filename_generator(new_name)
@@ -424,13 +794,38 @@ def rename_json_file(instance, new_name):
             raise exceptions.ValidationError('Error en el servidor.')
 
 
+def get_document_size(document):
+    """
+    Bytes que ocupa el JSON de una rutina guardado en la base de datos, que
+    se cuentan en el almacenamiento del usuario igual que un archivo.
+    """
+    if document is None:
+        return 0
+    
+    return len(json.dumps(document).encode('utf-8'))
+
+
 def remove_json_file(instance):
+    # Las rutinas con el documento en la base de datos no tienen archivo, 
+    # pero su documento sí cuenta en el almacenamiento
+    if not instance.json_rutina:
+        update_used_storage(
+            instance.autor, 
+            'routines', 
+            -get_document_size(instance.documento)
+        )
+        return
+    
+    routine_cache.invalidate(instance.json_rutina)
+
     try:
         rel_path = instance.json_rutina
         abs_path = os.path.join(settings.MEDIA_ROOT + '/' + rel_path)
 
         if os.path.exists(abs_path):
+            file_size = os.path.getsize(abs_path)
             os.remove(abs_path)
+            update_used_storage(instance.autor, 'routines', -file_size)
         else:
             raise exceptions.NotFound(f"El archivo {abs_path} no existe.")
         
@@ -439,7 +834,285 @@ def remove_json_file(instance):
         raise exceptions.ValidationError('Error en el servidor.')
 
 
+class RoutineDocumentCache:
+    '''
+    Caché LRU de los JSON de rutinas ya leídos desde disco, acotada a 
+    ROUTINE_CACHE_SIZE documentos por proceso.
+
+    La clave es (ruta, fecha de modificación, tamaño) del archivo, por lo 
+    que un archivo modificado nunca se confunde con su versión anterior y 
+    basta un os.stat() para validar la entrada. Si ROUTINE_CACHE_BACKEND
+    está configurado, los documentos también se comparten entre procesos a 
+    través de esa caché de Django.
+
+    Los contadores de aciertos y fallos son por proceso.
+    '''
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, relative_path):
+        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+        stat = os.stat(file_path)
+        key = (relative_path, stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            
+        shared_cache = self.get_shared_cache()
+
+        if shared_cache is not None:
+            document = shared_cache.get(self.shared_key(key))
+
+            if document is not None:
+                with self.lock:
+                    self.shared_hits += 1
+                self.store(key, document)
+                return document
+
+        with open(file_path, 'r') as json_file:
+            document = json.load(json_file)
+
+        with self.lock:
+            self.misses += 1
+
+        self.store(key, document)
+
+        if shared_cache is not None:
+            shared_cache.set(self.shared_key(key), document)
+
+        return document
+    
+    def store(self, key, document):
+        with self.lock:
+            self.entries[key] = document
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > settings.ROUTINE_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, relative_path):
+        '''
+        Descarta el documento de la ruta. Debe llamarse antes de modificar,
+        renombrar o eliminar el archivo.
+        '''
+        if not relative_path:
+            return
+        
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == relative_path]:
+                del self.entries[key]
+
+        shared_cache = self.get_shared_cache()
+
+        if shared_cache is not None:
+            with suppress(OSError):
+                stat = os.stat(os.path.join(settings.MEDIA_ROOT, relative_path))
+                key = (relative_path, stat.st_mtime_ns, stat.st_size)
+                shared_cache.delete(self.shared_key(key))
+
+    def get_shared_cache(self):
+        if not settings.ROUTINE_CACHE_BACKEND:
+            return None
+        
+        return caches[settings.ROUTINE_CACHE_BACKEND]
+    
+    def shared_key(self, key):
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return f'rutina:{digest}'
+    
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.shared_hits + self.misses
+
+            return {
+                'size': len(self.entries),
+                'max_size': settings.ROUTINE_CACHE_SIZE,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.shared_hits) / requests if requests else 0,
+                'shared_backend': settings.ROUTINE_CACHE_BACKEND,
+            }
+    
+
+routine_cache = RoutineDocumentCache()
+
+
+def get_routine_document(instance):
+    """
+    Retorna el JSON de la rutina: desde la base de datos si está ahí 
+    (Rutina.documento) o, si no, desde su archivo en disco.
+    """
+    if instance.documento is not None:
+        return instance.documento
+
+    try:
+        return routine_cache.get(instance.json_rutina)
+    except (OSError, ValueError):
+        raise exceptions.NotFound('No se ha encontrado el JSON de la rutina.')
+
+
+def get_routine_document_chunks(instance):
+    """
+    Retorna los bytes del JSON de la rutina tal como están guardados, por 
+    partes y sin decodificarlos. Los documentos de la base de datos se leen
+    como texto si la consulta los anotó en 'documento_raw'.
+    """
+    if hasattr(instance, 'documento_raw'):
+        if instance.documento_raw is not None:
+            return [instance.documento_raw.encode()]
+        
+    elif instance.documento is not None:
+        return [json.dumps(instance.documento).encode()]
+    
+    json_file_path = os.path.join(settings.MEDIA_ROOT, instance.json_rutina)
+
+    try:
+        json_file = open(json_file_path, 'rb')
+    except OSError:
+        raise exceptions.NotFound('No se ha encontrado el JSON de la rutina.')
+    
+    def read_chunks():
+        with json_file:
+            for chunk in iter(lambda: json_file.read(READ_SIZE), b''):
+                yield chunk
+
+    return read_chunks()
+
+
+def save_routine_document(instance, user_instance, content_name, content_json):
+    """
+    Guarda el nuevo JSON de la rutina, en la base de datos o en un archivo 
+    según ROUTINE_DOCUMENTS_IN_DATABASE, y elimina el archivo anterior si lo
+    hay. Retorna la ruta relativa del archivo ('' si se guardó en la base 
+    de datos) y el documento a guardar en la base de datos (o None).
+
+    NOTA: Sólo modifica la instancia; debe guardarse luego con save().
+    """
+    if instance is not None:
+        remove_json_file(instance)
+
+    if settings.ROUTINE_DOCUMENTS_IN_DATABASE:
+        document = content_json
+        relative_path = ''
+
+        # El contador se inicializa desde el disco, donde no está el documento
+        get_storage_ledger(user_instance.id)
+        update_used_storage(
+            user_instance, 
+            'routines', 
+            get_document_size(document)
+        )
+    else:
+        document = None
+        relative_path = create_json_file(
+            user_instance=user_instance,
+            content_name=content_name,
+            content_json=content_json
+        )
+
+    if instance is not None:
+        instance.documento = document
+        instance.json_rutina = relative_path
+
+    return relative_path, document
+
+
+@transaction.atomic
+def move_routine_document(routine_id):
+    """
+    Deja el JSON de la rutina donde indica ROUTINE_DOCUMENTS_IN_DATABASE 
+    (e.g. al cambiar ese ajuste), con una única copia que cuenta en el 
+    almacenamiento del usuario. Retorna True si la rutina cambió.
+
+    El archivo anterior se elimina recién al confirmar la transacción.
+    """
+    routine = Rutina.objects.select_for_update().select_related('autor') \
+        .filter(pk=routine_id).first()
+
+    if routine is None:
+        return False
+
+    user = routine.autor
+    old_path = routine.json_rutina
+
+    # El contador se inicializa desde el disco antes de aplicar la diferencia
+    get_storage_ledger(user.id)
+
+    if settings.ROUTINE_DOCUMENTS_IN_DATABASE:
+        if not old_path:
+            return False
+
+        file_path = os.path.join(settings.MEDIA_ROOT, old_path)
+
+        with open(file_path, 'r') as json_file:
+            document = json.load(json_file)
+
+        file_size = os.path.getsize(file_path)
+
+        routine.documento = document
+        routine.json_rutina = ''
+        routine.save(update_fields=['documento', 'json_rutina'])
+        update_used_storage(
+            user, 
+            'routines', 
+            get_document_size(document) - file_size
+        )
+
+        def remove_old_file():
+            routine_cache.invalidate(old_path)
+
+            with suppress(FileNotFoundError):
+                os.remove(file_path)
+
+        transaction.on_commit(remove_old_file)
+
+        return True
+    
+    if routine.documento is None:
+        return False
+    
+    # El archivo ya es la copia vigente (e.g. la migración 0008 copió el 
+    # documento sin eliminarlo); el documento nunca se cobró
+    if old_path:
+        routine.documento = None
+        routine.save(update_fields=['documento'])
+
+        return True
+    
+    routine.json_rutina = create_json_file(
+        user_instance=user,
+        content_name=routine.nombre,
+        content_json=routine.documento
+    )
+    update_used_storage(user, 'routines', -get_document_size(routine.documento))
+    routine.documento = None
+    routine.save(update_fields=['documento', 'json_rutina'])
+
+    return True
+
+
+def rename_routine_document(instance, new_name):
+    # El documento guardado en la base de datos no depende del nombre
+    if not instance.json_rutina:
+        return instance.json_rutina
+    
+    return rename_json_file(instance, new_name)
+
+
 def rename_cover_file(instance, new_name):
+    # Las rutinas sin portada no tienen archivo que renombrar
+    if not instance.url_portada:
+        return instance.url_portada
+
     try:
         instance.url_portada.close()
 
@@ -453,6 +1126,12 @@ def rename_cover_file(instance, new_name):
 
         new_relative_path = os.path.relpath(new_path, settings.MEDIA_ROOT)
 
+        instance.miniaturas = relocate_derivatives(
+            instance.miniaturas, 
+            instance.url_portada.name, 
+            new_relative_path
+        )
+
         return new_relative_path
     
     except OSError as e:
@@ -477,7 +1156,10 @@ def remove_cover_file(instance):
             
             file.close()
 
+            file_size = os.path.getsize(file_path)
             os.remove(file_path)
+            remove_derivatives(file.name)
+            update_used_storage(instance.autor, 'covers', -file_size)
 
     except OSError as e:
         print(f"Error en remove_cover_file(): {e}")
@@ -489,7 +1171,8 @@ def create_routine_instance(
         content_model, 
         content_name, 
         relative_path,
-        json_file_path
+        json_file_path,
+        document=None
     ):
     """
     Crea y retorna la instancia del contenido Rutina en la base de datos.
@@ -501,6 +1184,7 @@ def create_routine_instance(
     content = content_model.objects.create(
         nombre=content_name,
         json_rutina=json_file_path,
+        documento=document,
         url_portada=relative_path,
         autor=user_instance
     )
@@ -508,6 +1192,7 @@ def create_routine_instance(
     return content
 
 
+@transaction.atomic
 def create_routine(content_model, user_model, content_folder, validated_data):
     """
     Función matriz que genera el contenido especialmente para el modelo Rutina
@@ -525,9 +1210,14 @@ def create_routine(content_model, user_model, content_folder, validated_data):
         content_file = validated_data['url_portada']
         content_json = validated_data['json_rutina']
 
-        # Obtener la instancia de usuario y crear el archivo JSON de la rutina
+        # Obtener la instancia de usuario y guardar el JSON de la rutina
         user = get_user_instance(user_id, user_model)
-        base_file = create_json_file(user, content_name, content_json)
+        base_file, document = save_routine_document(
+            instance=None, 
+            user_instance=user, 
+            content_name=content_name, 
+            content_json=content_json
+        )
         
         if content_file:
             # Guarda el archivo
@@ -544,9 +1234,21 @@ def create_routine(content_model, user_model, content_folder, validated_data):
             content_model=content_model,
             content_name=content_name,
             relative_path=relative_path,
-            json_file_path=base_file
+            json_file_path=base_file,
+            document=document
         )
 
+        sync_routine_media_links(content_instance, content_json)
+
+        # Confirma la reserva de almacenamiento de la subida, si la hay
+        reservation = validated_data.get('reservation')
+
+        if reservation:
+            reservation.commit()
+
+        if content_file:
+            schedule_media_processing(content_instance)
+
         return content_instance
     
     except OSError as e:
@@ -554,6 +1256,7 @@ def create_routine(content_model, user_model, content_folder, validated_data):
         raise exceptions.ValidationError('Error en el servidor.')
 
 
+@transaction.atomic
 def update_routine_instance(
         content_model,
         user_model, 
@@ -588,6 +1291,13 @@ def update_routine_instance(
 
         user = get_user_instance(user_id=user_id, user_model=user_model)
 
+        # Cualquier cambio invalida la versión que tengan los clientes
+        # (ver patch_routine_instance)
+        if new_content_name != old_content_name or \
+        new_content_file != old_content_file or \
+        new_content_json != old_content_json:
+            instance.version += 1
+
         '''
         Opciones:
         1. Si en el request hay nuevo archivo (pero se mantiene nombre y json)
@@ -625,14 +1335,13 @@ def update_routine_instance(
         new_content_json == old_content_json:
             print('--update_rutina_instance: option #2') # debug
 
-            new_json_filename = rename_json_file(instance, new_content_name)
-
-            new_cover_filename = rename_file(
+            new_json_filename = rename_routine_document(
                 instance, 
-                new_content_name, 
-                content_model
+                new_content_name
             )
 
+            new_cover_filename = rename_cover_file(instance, new_content_name)
+
             instance.nombre = new_content_name
             instance.json_rutina = new_json_filename
             instance.url_portada = new_cover_filename
@@ -644,14 +1353,13 @@ def update_routine_instance(
         new_content_name == old_content_name:
             print('--update_rutina_instance: option #3') # debug
             
-            remove_json_file(instance)
-            new_json_file = create_json_file(
+            save_routine_document(
+                instance=instance,
                 user_instance=user,
                 content_name=old_content_name,
                 content_json=new_content_json
             )
 
-            instance.json_rutina = new_json_file
             instance.save()
 
         # 4
@@ -660,7 +1368,10 @@ def update_routine_instance(
         new_content_json == old_content_json:
             print('--update_rutina_instance: option #4') # debug
 
-            new_json_filename = rename_json_file(instance, new_content_name)
+            new_json_filename = rename_routine_document(
+                instance, 
+                new_content_name
+            )
 
             remove_cover_file(instance)
             new_file = save_file(
@@ -683,8 +1394,8 @@ def update_routine_instance(
         new_content_name == old_content_name:
             print('--update_rutina_instance: option #5') # debug
 
-            remove_json_file(instance)
-            new_json_file = create_json_file(
+            save_routine_document(
+                instance=instance,
                 user_instance=user,
                 content_name=old_content_name,
                 content_json=new_content_json
@@ -700,7 +1411,6 @@ def update_routine_instance(
             
             new_relative_path = os.path.relpath(new_file, settings.MEDIA_ROOT)
 
-            instance.json_rutina = new_json_file
             instance.url_portada = new_relative_path
             instance.save()
 
@@ -710,21 +1420,16 @@ def update_routine_instance(
         new_content_file == old_content_file:
             print('--update_rutina_instance: option #6') # debug
 
-            remove_json_file(instance)
-            new_json_file = create_json_file(
+            save_routine_document(
+                instance=instance,
                 user_instance=user,
                 content_name=new_content_name,
                 content_json=new_content_json
             )
 
-            new_cover_filename = rename_file(
-                instance, 
-                new_content_name, 
-                content_model
-            )
+            new_cover_filename = rename_cover_file(instance, new_content_name)
 
             instance.nombre = new_content_name
-            instance.json_rutina = new_json_file
             instance.url_portada = new_cover_filename
             instance.save()
 
@@ -734,8 +1439,8 @@ def update_routine_instance(
         new_content_file != old_content_file:
             print('--update_rutina_instance: option #7') # debug
 
-            remove_json_file(instance)
-            new_json_file = create_json_file(
+            save_routine_document(
+                instance=instance,
                 user_instance=user,
                 content_name=new_content_name,
                 content_json=new_content_json
@@ -753,7 +1458,6 @@ def update_routine_instance(
 
             instance.nombre = new_content_name
             instance.url_portada = new_relative_path
-            instance.json_rutina = new_json_file
             instance.save()
         
         # 8
@@ -761,8 +1465,2054 @@ def update_routine_instance(
             print('No se han realizado cambios al contenido.') # debug
             pass
 
+        if new_content_json != old_content_json:
+            sync_routine_media_links(instance, new_content_json)
+
+        # Regenera las miniaturas si cambió la portada
+        if new_content_file and new_content_file != old_content_file:
+            schedule_media_processing(instance)
+
         return instance
         
     except OSError as e:
         print(f"Error en update_content(): {e.strerror}") # debug
         raise exceptions.ValidationError('Error en el servidor.')
+
+
+# ------------------------------------------------------------------------------
+# Almacenamiento por contenido (pictogramas y audios deduplicados)
+# ------------------------------------------------------------------------------
+
+def is_content_addressed(content_folder):
+    return settings.CONTENT_ADDRESSED_STORAGE and \
+        content_folder in CONTENT_ADDRESSED_FOLDERS
+
+
+def is_blob_path(relative_path):
+    return str(relative_path).startswith('blobs/')
+
+
+def hash_file(file):
+    """
+    Retorna el hash SHA-256 del archivo, leyéndolo por partes.
+    """
+    digest = hashlib.sha256()
+
+    for chunk in file.chunks():
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def blob_path_generator(file_hash, file):
+    """
+    Retorna la ruta relativa del blob, repartida en subcarpetas según el 
+    prefijo del hash para no acumular demasiados archivos en una carpeta:
+
+    "blobs/{hash[0:2]}/{hash[2:4]}/{hash}.{extension}"
+    """
+    _, extension = os.path.splitext(file.name)
+
+    return os.path.join(
+        'blobs', 
+        file_hash[:2], 
+        file_hash[2:4], 
+        f'{file_hash}{extension.lower()}'
+    )
+
+
+def write_blob_file(file, relative_path):
+    """
+    Escribe el contenido del blob en disco, sólo si aún no existe.
+
+    NOTA: No consulta la base de datos, por lo que puede ejecutarse en
+    paralelo. El registro del blob lo realiza register_blob().
+    """
+    file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+
+    if not os.path.exists(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        write_uploaded_file(file, file_path)
+
+    return file_path
+
+
+def lock_blob_hash(file_hash):
+    """
+    Bloquea el hash hasta el fin de la transacción en curso, para que el 
+    registro de un blob y la eliminación de su archivo no se crucen: sin el
+    bloqueo, una subida podía registrar el mismo contenido (sin confirmar 
+    aún) mientras otra eliminaba el archivo por haber quedado sin 
+    referencias.
+
+    En PostgreSQL usa un advisory lock; las demás bases de datos ya 
+    serializan las escrituras.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [int(file_hash[:15], 16)])
+
+
+def register_blob(file_hash, relative_path, size):
+    """
+    Registra una nueva referencia al blob (lo crea si no existe).
+    Debe llamarse dentro de la transacción que crea la instancia, que 
+    mantiene el bloqueo del hash hasta confirmarse.
+    """
+    with transaction.atomic():
+        lock_blob_hash(file_hash)
+
+        blob, created = MediaBlob.objects.get_or_create(
+            hash=file_hash,
+            defaults={'ruta': relative_path, 'size': size, 'ref_count': 1}
+        )
+
+        if not created:
+            MediaBlob.objects.filter(pk=blob.pk).update(
+                ref_count=F('ref_count') + 1
+            )
+
+    return blob
+
+
+def reference_existing_blob(file_hash):
+    """
+    Suma una referencia a un blob ya guardado y lo retorna, o retorna None
+    si no existe (o si su archivo ya no está en disco).
+    Debe llamarse dentro de la transacción que crea la instancia.
+    """
+    with transaction.atomic():
+        lock_blob_hash(file_hash)
+        blob = MediaBlob.objects.filter(hash=file_hash).first()
+
+        if blob is None or \
+                not os.path.exists(os.path.join(settings.MEDIA_ROOT, blob.ruta)):
+            return None
+        
+        MediaBlob.objects.filter(pk=blob.pk).update(
+            ref_count=F('ref_count') + 1
+        )
+
+    return blob
+
+
+def save_blob(file):
+    """
+    Guarda el archivo en el almacenamiento por contenido y retorna la ruta
+    absoluta del blob. Si ya existe un blob idéntico, sólo se suma una
+    referencia y el archivo no se vuelve a escribir.
+    """
+    file_hash = hash_file(file)
+    blob = register_blob(
+        file_hash, 
+        blob_path_generator(file_hash, file), 
+        file.size
+    )
+
+    return write_blob_file(file, blob.ruta)
+
+
+def release_blob(relative_path):
+    """
+    Resta una referencia al blob. Al quedar sin referencias, se elimina su 
+    registro y, una vez confirmada la transacción, también el archivo.
+    """
+    file_hash, _ = os.path.splitext(os.path.basename(relative_path))
+
+    with transaction.atomic():
+        lock_blob_hash(file_hash)
+        blob = MediaBlob.objects.select_for_update().filter(
+            hash=file_hash
+        ).first()
+
+        if blob is None:
+            raise exceptions.NotFound("Archivo no encontrado o ruta errónea.")
+
+        if blob.ref_count > 1:
+            MediaBlob.objects.filter(pk=blob.pk).update(
+                ref_count=F('ref_count') - 1
+            )
+            return
+        
+        blob.delete()
+        transaction.on_commit(lambda: remove_unreferenced_blob(blob))
+
+
+def remove_unreferenced_blob(blob):
+    with transaction.atomic():
+        # Espera a que confirme una subida que esté registrando el mismo hash
+        lock_blob_hash(blob.hash)
+
+        # Otra subida pudo volver a registrar el mismo contenido entretanto
+        if MediaBlob.objects.filter(hash=blob.hash).exists():
+            return
+
+        try:
+            os.remove(os.path.join(settings.MEDIA_ROOT, blob.ruta))
+        except FileNotFoundError:
+            pass
+
+        remove_derivatives(blob.ruta)
+
+
+# ------------------------------------------------------------------------------
+# Miniaturas (derivados) de pictogramas y portadas
+# ------------------------------------------------------------------------------
+
+def derivatives_folder(relative_path):
+    """
+    Retorna la carpeta (relativa a MEDIA_ROOT) de las miniaturas de un archivo:
+
+    "derivatives/{ruta_del_original_sin_extension}/"
+
+    Queda fuera de 'user_content', por lo que no consume almacenamiento del
+    usuario, y los blobs compartidos también comparten sus miniaturas.
+    """
+    base, _ = os.path.splitext(str(relative_path))
+
+    return os.path.join('derivatives', base)
+
+
+def generate_derivatives(relative_path):
+    """
+    Genera las miniaturas de la imagen en cada tamaño de THUMBNAIL_SIZES y
+    formato de DERIVATIVE_FORMATS. Retorna sus rutas relativas con la forma:
+
+    {"64": {"webp": "derivatives/.../64.webp", "png": "..."}, ...}
+
+    Si la imagen no se puede procesar, retorna un diccionario vacío y el 
+    cliente sigue usando la imagen original.
+    """
+    media_root = settings.MEDIA_ROOT
+    folder = derivatives_folder(relative_path)
+    derivatives = {}
+
+    try:
+        os.makedirs(os.path.join(media_root, folder), exist_ok=True)
+
+        with Image.open(os.path.join(media_root, relative_path)) as image:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+
+            for size in settings.THUMBNAIL_SIZES:
+                thumbnail = image.copy()
+                thumbnail.thumbnail((size, size))
+                derivatives[str(size)] = {}
+
+                for extension, image_format in DERIVATIVE_FORMATS.items():
+                    derivative_path = os.path.join(folder, f'{size}.{extension}')
+                    file_path = os.path.join(media_root, derivative_path)
+
+                    # Las miniaturas de un blob compartido ya pueden existir
+                    if not os.path.exists(file_path):
+                        with atomic_write(file_path) as f:
+                            thumbnail.save(f, format=image_format)
+
+                    derivatives[str(size)][extension] = derivative_path
+
+        return derivatives
+    
+    except (OSError, Image.DecompressionBombError) as e:
+        print(f"Error en generate_derivatives(): {e}") # debug
+        return {}
+
+
+def remove_derivatives(relative_path):
+    folder = derivatives_folder(relative_path)
+    shutil.rmtree(os.path.join(settings.MEDIA_ROOT, folder), ignore_errors=True)
+
+
+def relocate_derivatives(derivatives, old_relative_path, new_relative_path):
+    """
+    Mueve las miniaturas junto con su archivo original renombrado y retorna
+    sus nuevas rutas relativas.
+    """
+    if not derivatives:
+        return derivatives
+    
+    old_folder = derivatives_folder(old_relative_path)
+    new_folder = derivatives_folder(new_relative_path)
+
+    old_path = os.path.join(settings.MEDIA_ROOT, old_folder)
+
+    if os.path.exists(old_path):
+        os.rename(old_path, os.path.join(settings.MEDIA_ROOT, new_folder))
+
+    return {
+        size: {
+            extension: os.path.join(new_folder, os.path.basename(path))
+            for extension, path in formats.items()
+        }
+        for size, formats in derivatives.items()
+    }
+
+
+def process_content_media(instance):
+    """
+    Genera y registra en la instancia las miniaturas de su imagen 
+    (pictograma o portada de rutina). Otros contenidos no se procesan.
+    """
+    source_field = DERIVATIVE_SOURCES.get(instance._meta.verbose_name)
+
+    if source_field is None:
+        return instance
+    
+    source = getattr(instance, source_field)
+    instance.miniaturas = generate_derivatives(source.name) if source else {}
+    instance.estado = 'listo'
+    instance.save(update_fields=['miniaturas', 'estado', 'ultima_modificacion'])
+
+    return instance
+
+
+def schedule_media_processing(instance):
+    """
+    Procesa la imagen de la instancia durante la petición o, si 
+    MEDIA_PROCESSING_ASYNC está activo, la deja en estado 'pendiente' y 
+    agrega la tarea a la cola (ver el comando run_worker).
+    """
+    if instance._meta.verbose_name not in DERIVATIVE_SOURCES:
+        return instance
+    
+    if not settings.MEDIA_PROCESSING_ASYNC:
+        return process_content_media(instance)
+    
+    instance.estado = 'pendiente'
+    instance.save(update_fields=['estado', 'ultima_modificacion'])
+
+    enqueue_job('process_media', {
+        'model': instance._meta.label,
+        'id': instance.pk,
+    })
+
+    return instance
+
+
+@job_handler('process_media')
+def process_media_job(job):
+    model = apps.get_model(job.payload['model'])
+    instance = model.objects.filter(pk=job.payload['id']).first()
+
+    if instance is None:
+        # El contenido se eliminó antes de procesarse
+        return
+    
+    source_field = DERIVATIVE_SOURCES[instance._meta.verbose_name]
+    source_name = getattr(instance, source_field).name
+
+    model.objects.filter(pk=instance.pk).update(
+        estado='procesando', 
+        ultima_modificacion=timezone.now()
+    )
+
+    try:
+        derivatives = generate_derivatives(source_name) if source_name else {}
+
+    except Exception:
+        if job.attempts >= settings.PROCESSING_JOB_MAX_ATTEMPTS:
+            model.objects.filter(pk=instance.pk).update(
+                estado='error', 
+                ultima_modificacion=timezone.now()
+            )
+
+            if getattr(instance, 'es_precargado', False):
+                bump_preloaded_catalog(model)
+        raise
+
+    # Si el archivo se reemplazó entretanto, su propia tarea lo procesará
+    is_current = model.objects.filter(
+        pk=instance.pk, 
+        **{source_field: source_name}
+    ).exists()
+
+    if is_current:
+        instance.miniaturas = derivatives
+        instance.estado = 'listo'
+        instance.save(
+            update_fields=['miniaturas', 'estado', 'ultima_modificacion']
+        )
+
+
+def get_derivative_urls(derivatives, request=None):
+    """
+    Retorna las URLs de las miniaturas, absolutas si se cuenta con el request.
+    """
+    urls = {}
+
+    for size, formats in (derivatives or {}).items():
+        urls[size] = {}
+
+        for extension, path in formats.items():
+            url = default_storage.url(path)
+            urls[size][extension] = request.build_absolute_uri(url) \
+                if request else url
+
+    return urls
+
+
+# ------------------------------------------------------------------------------
+# Subidas reanudables por partes
+# ------------------------------------------------------------------------------
+
+class ChunkedUploadedFile(UploadedFile):
+    """
+    Archivo armado en disco a partir de una subida por partes. Se comporta
+    como un TemporaryUploadedFile, por lo que save_file lo mueve a su destino
+    en vez de copiarlo.
+    """
+
+    def __init__(self, file_path, name, content_type, size):
+        super().__init__(open(file_path, 'rb'), name, content_type, size)
+        self.file_path = file_path
+
+    def temporary_file_path(self):
+        return self.file_path
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            pass
+
+
+def upload_part_path(session):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f'{session.id}.part')
+
+
+def create_upload_part(session):
+    try:
+        os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+        open(upload_part_path(session), 'wb').close()
+
+    except OSError as e:
+        print(f"Error en create_upload_part(): {e.strerror}") # debug
+        raise exceptions.ValidationError('Error en el servidor.')
+
+
+def write_upload_chunk(session, offset, stream, length):
+    """
+    Escribe directo en disco la parte recibida a partir de offset, leyéndola
+    del request de a CHUNKED_UPLOAD_READ_SIZE bytes (la memoria usada no 
+    depende del tamaño de la parte). Reenviar una parte ya recibida sólo 
+    la sobrescribe con los mismos bytes.
+
+    Retorna la cantidad de bytes recibidos hasta ahora, incluso si la
+    conexión se corta a mitad de la parte.
+    """
+    file_path = upload_part_path(session)
+    remaining = length
+
+    try:
+        with open(file_path, 'r+b') as f:
+            f.seek(offset)
+
+            while remaining > 0:
+                read_size = min(settings.CHUNKED_UPLOAD_READ_SIZE, remaining)
+                chunk = stream.read(read_size)
+
+                if not chunk:
+                    break
+
+                f.write(chunk)
+                remaining -= len(chunk)
+
+    except OSError as e:
+        print(f"Error en write_upload_chunk(): {e.strerror}") # debug
+        raise exceptions.ValidationError('Error en el servidor.')
+
+    finally:
+        if os.path.exists(file_path):
+            session.offset = os.path.getsize(file_path)
+            session.save(update_fields=['offset', 'updated_at'])
+
+    return session.offset
+
+
+def get_upload_session_file(session):
+    """
+    Retorna el archivo completo de la subida, listo para el flujo de creación.
+    """
+    file_path = upload_part_path(session)
+
+    if not os.path.exists(file_path):
+        raise exceptions.NotFound('Archivo no encontrado o ruta errónea.')
+    
+    return ChunkedUploadedFile(
+        file_path, 
+        session.filename, 
+        session.content_type, 
+        session.size
+    )
+
+
+@transaction.atomic
+def create_upload_session(serializer, user):
+    """
+    Crea la subida y reserva su tamaño en el almacenamiento del usuario 
+    hasta que se finalice o se cancele, por lo que los archivos parciales
+    también cuentan en su límite.
+
+    El contador del usuario queda bloqueado mientras se cuentan sus subidas
+    abiertas, para que dos peticiones paralelas no superen el máximo.
+    """
+    get_storage_ledger(user.id)
+    list(UserStorage.objects.select_for_update().filter(user_id=user.id))
+
+    open_sessions = UploadSession.objects.filter(user=user.id).count()
+
+    if open_sessions >= settings.CHUNKED_UPLOAD_MAX_SESSIONS:
+        msg = 'Hay demasiadas subidas en curso. Finaliza o cancela alguna.'
+        raise exceptions.ValidationError(msg)
+
+    reservation = StorageReservation(user, serializer.validated_data['size'])
+    reservation.acquire()
+
+    session = serializer.save(user=user, reserved_storage=reservation.size)
+    create_upload_part(session)
+
+    return session
+
+
+def release_upload_reservation(session):
+    reservation = StorageReservation(session.user, session.reserved_storage)
+    reservation.is_active = bool(reservation.size)
+    reservation.release()
+
+
+@transaction.atomic
+def remove_upload_session(session, release_storage=True):
+    """
+    Elimina la subida y su archivo parcial y libera el espacio reservado 
+    (salvo que ya se haya usado para crear el contenido). Si otra petición
+    ya la eliminó, no vuelve a liberar la reserva.
+    """
+    deleted, _ = UploadSession.objects.filter(pk=session.pk).delete()
+
+    if deleted and release_storage:
+        release_upload_reservation(session)
+
+    with suppress(FileNotFoundError):
+        os.remove(upload_part_path(session))
+
+
+def remove_expired_upload_sessions(user=None):
+    """
+    Elimina las subidas sin actividad por más de CHUNKED_UPLOAD_EXPIRY_HOURS,
+    del usuario o, sin él, de todos los usuarios. Retorna cuántas eliminó.
+    """
+    expiry = timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+    expired_sessions = UploadSession.objects.filter(
+        updated_at__lt=timezone.now() - expiry
+    ).select_related('user')
+
+    if user is not None:
+        expired_sessions = expired_sessions.filter(user=user.id)
+
+    removed = 0
+
+    for session in expired_sessions.iterator():
+        remove_upload_session(session)
+        removed += 1
+
+    return removed
+
+
+def remove_orphan_upload_parts():
+    """
+    Elimina los archivos parciales sin una subida que los registre (e.g. 
+    si el proceso se detuvo al crearla), con la misma antigüedad que las 
+    subidas vencidas. Retorna cuántos eliminó.
+    """
+    expiry = settings.CHUNKED_UPLOAD_EXPIRY_HOURS * 60 * 60
+    session_ids = {
+        str(session_id) 
+        for session_id in UploadSession.objects.values_list('id', flat=True)
+    }
+    removed = 0
+
+    try:
+        entries = list(os.scandir(settings.CHUNKED_UPLOAD_DIR))
+    except FileNotFoundError:
+        return removed
+
+    for entry in entries:
+        session_id, extension = os.path.splitext(entry.name)
+
+        if extension != '.part' or session_id in session_ids:
+            continue
+
+        with suppress(FileNotFoundError):
+            if time.time() - entry.stat().st_mtime > expiry:
+                os.remove(entry.path)
+                removed += 1
+
+    return removed
+
+
+def get_upload_session_reservations(user_ids):
+    """
+    Retorna, por usuario, los bytes reservados por sus subidas abiertas.
+    """
+    return dict(
+        UploadSession.objects
+        .filter(user_id__in=user_ids)
+        .values('user_id')
+        .annotate(total=Sum('reserved_storage'))
+        .values_list('user_id', 'total')
+    )
+
+
+# ------------------------------------------------------------------------------
+# Subidas en lote (pictogramas y audios)
+# ------------------------------------------------------------------------------
+
+def prepare_batch_items(user, content_folder, items):
+    """
+    Asigna a cada elemento del lote la ruta donde se guardará su archivo.
+    Los blobs se ubican según su hash, que se calcula al escribirlos.
+    """
+    claimed_paths = set()
+
+    for item in items:
+        if is_content_addressed(content_folder):
+            item['file_path'] = None
+            continue
+
+        name = item['nombre']
+        filename = filename_generator(name, item['ruta'])
+
+        # Evita que dos archivos del lote con el mismo nombre coincidan
+        if filename in claimed_paths:
+            filename = filename_generator(f'{name}_{item["index"]}', item['ruta'])
+
+        claimed_paths.add(filename)
+        item['file_path'] = path_generator(
+            user_instance=user, 
+            content_type=content_folder, 
+            filename=filename
+        )
+
+    return items
+
+
+def write_batch_item(content_model, content_folder, item):
+    """
+    Escribe en disco el archivo de un elemento del lote y, si las miniaturas
+    no se procesan en segundo plano, también las genera.
+
+    NOTA: No consulta la base de datos, por lo que se ejecuta en paralelo.
+    """
+    file = item['ruta']
+
+    if is_content_addressed(content_folder):
+        item['hash'] = hash_file(file)
+        relative_path = blob_path_generator(item['hash'], file)
+        item['file_path'] = write_blob_file(file, relative_path)
+    else:
+        write_uploaded_file(file, item['file_path'])
+
+    item['relative_path'] = os.path.relpath(item['file_path'], settings.MEDIA_ROOT)
+    item['size'] = os.path.getsize(item['file_path'])
+    item['miniaturas'] = {}
+
+    has_derivatives = content_model._meta.verbose_name in DERIVATIVE_SOURCES
+
+    if has_derivatives and not settings.MEDIA_PROCESSING_ASYNC:
+        item['miniaturas'] = generate_derivatives(item['relative_path'])
+
+    return item
+
+
+def remove_batch_files(items):
+    """
+    Elimina los archivos escritos por un lote que no llegó a registrarse.
+    """
+    for item in items:
+        relative_path = item.get('relative_path')
+
+        if not relative_path:
+            continue
+
+        if is_blob_path(relative_path):
+            # Sólo si ningún otro contenido referencia el mismo blob
+            remove_unreferenced_blob(
+                MediaBlob(hash=item['hash'], ruta=relative_path)
+            )
+        else:
+            with suppress(FileNotFoundError):
+                os.remove(item['file_path'])
+
+            remove_derivatives(relative_path)
+
+
+def create_content_batch(content_model, user_model, content_folder, validated_data):
+    """
+    Función matriz que genera muchos contenidos (pictogramas o sonidos) en
+    una sola operación:
+
+    1. Escribe los archivos (y sus miniaturas) en paralelo, en 
+       BATCH_UPLOAD_WORKERS hilos.
+    2. En una única transacción, inserta las instancias con bulk_create, 
+       registra los blobs y actualiza una sola vez el contador de 
+       almacenamiento del usuario.
+
+    Si algo falla, no se registra ningún elemento y se eliminan los archivos
+    ya escritos. Retorna las instancias en el mismo orden que los elementos.
+
+    Parámetros:
+    - validated_data = Datos de ContentBatchSerializer; cada elemento de 
+      'items' contiene index, nombre y ruta (el archivo subido)
+    """
+    user = get_user_instance(validated_data['autor'], user_model)
+    items = validated_data['items']
+
+    try:
+        prepare_batch_items(user, content_folder, items)
+
+        with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_WORKERS) as pool:
+            futures = [
+                pool.submit(write_batch_item, content_model, content_folder, item)
+                for item in items
+            ]
+
+        for future in futures:
+            future.result()
+
+        with transaction.atomic():
+            instances = create_batch_instances(
+                user_instance=user, 
+                content_model=content_model, 
+                content_folder=content_folder, 
+                items=items
+            )
+
+            # Confirma la reserva de almacenamiento del lote, si la hay
+            reservation = validated_data.get('reservation')
+
+            if reservation:
+                reservation.commit()
+
+        return instances
+    
+    except OSError as e:
+        remove_batch_files(items)
+        print(f"Error en create_content_batch(): {e.strerror}") # debug
+        raise exceptions.ValidationError('Error en el servidor.')
+    
+    except Exception:
+        remove_batch_files(items)
+        raise
+
+
+def restore_batch_blob(item):
+    """
+    El blob del elemento se escribió antes de registrarlo: si ya existía, 
+    pudo eliminarse entretanto al quedar sin referencias. Con el hash ya 
+    bloqueado por register_blob(), se vuelve a escribir (junto con sus 
+    miniaturas) si falta.
+    """
+    file_path = os.path.join(settings.MEDIA_ROOT, item['relative_path'])
+
+    if os.path.exists(file_path):
+        return item
+    
+    write_blob_file(item['ruta'], item['relative_path'])
+
+    if item['miniaturas']:
+        item['miniaturas'] = generate_derivatives(item['relative_path'])
+
+    return item
+
+
+def create_batch_instances(user_instance, content_model, content_folder, items):
+    """
+    Inserta las instancias del lote con bulk_create (junto con su historial).
+    Debe llamarse dentro de una transacción.
+    """
+    is_async = settings.MEDIA_PROCESSING_ASYNC and \
+        content_model._meta.verbose_name in DERIVATIVE_SOURCES
+    objects = []
+
+    for item in items:
+        if is_blob_path(item['relative_path']):
+            register_blob(item['hash'], item['relative_path'], item['size'])
+            restore_batch_blob(item)
+
+        content = content_model(
+            nombre=item['nombre'],
+            nombre_normalizado=normalize_name(item['nombre']),
+            ruta=item['relative_path'],
+            autor=user_instance,
+            es_precargado=user_instance.is_staff
+        )
+
+        if content_model._meta.verbose_name in DERIVATIVE_SOURCES:
+            content.miniaturas = item['miniaturas']
+            content.estado = 'pendiente' if is_async else 'listo'
+
+        objects.append(content)
+
+    instances = bulk_create_with_history(
+        objects, 
+        content_model, 
+        default_user=user_instance
+    )
+
+    total_size = sum(item['size'] for item in items)
+    update_used_storage(user_instance, content_folder, total_size)
+
+    # bulk_create no envía post_save
+    if user_instance.is_staff:
+        transaction.on_commit(lambda: bump_preloaded_catalog(content_model))
+
+    if is_async:
+        ProcessingJob.objects.bulk_create([
+            ProcessingJob(
+                kind='process_media', 
+                payload={'model': content_model._meta.label, 'id': instance.pk}
+            )
+            for instance in instances
+        ])
+
+    return instances
+
+
+def get_batch_results(instances, validated_data, serializer):
+    """
+    Retorna el resultado de cada elemento del lote, en el orden en que se
+    enviaron, y el código de estado de la respuesta:
+
+    - 201 si se crearon todos.
+    - 207 si sólo se crearon algunos.
+    - 400 si no se creó ninguno.
+    """
+    results = [
+        {
+            'index': item['index'], 
+            'status': status.HTTP_201_CREATED, 
+            'data': serializer(instance).data
+        }
+        for item, instance in zip(validated_data['items'], instances)
+    ]
+    results.extend(validated_data['errors'])
+    results.sort(key=lambda result: result['index'])
+
+    if not validated_data['errors']:
+        status_code = status.HTTP_201_CREATED
+    elif instances:
+        status_code = status.HTTP_207_MULTI_STATUS
+    else:
+        status_code = status.HTTP_400_BAD_REQUEST
+
+    return {'results': results}, status_code
+
+
+# ------------------------------------------------------------------------------
+# Modificaciones parciales del JSON de rutinas (JSON Patch y JSON Merge Patch)
+# ------------------------------------------------------------------------------
+
+class PreconditionFailed(exceptions.APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'La rutina fue modificada por otra petición.'
+    default_code = 'precondition_failed'
+
+
+def parse_json_pointer(pointer):
+    """
+    Retorna las partes de un JSON Pointer (RFC 6901), e.g. "/pasos/0/texto"
+    -> ['pasos', '0', 'texto']. La cadena vacía apunta al documento completo.
+    """
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise exceptions.ValidationError(f'Ruta inválida: {pointer}')
+
+    if not pointer:
+        return []
+    
+    return [
+        token.replace('~1', '/').replace('~0', '~') 
+        for token in pointer[1:].split('/')
+    ]
+
+
+def get_list_index(container, token, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise exceptions.ValidationError(f'Índice inválido: {token}')
+    
+    index = int(token)
+    max_index = len(container) if allow_end else len(container) - 1
+
+    if index > max_index:
+        raise exceptions.ValidationError(f'Índice fuera de rango: {token}')
+    
+    return index
+
+
+def resolve_json_pointer(document, tokens):
+    for token in tokens:
+        if isinstance(document, list):
+            document = document[get_list_index(document, token)]
+        elif isinstance(document, dict) and token in document:
+            document = document[token]
+        else:
+            raise exceptions.ValidationError(f'Ruta inexistente: /{token}')
+        
+    return document
+
+
+def add_json_value(document, tokens, value):
+    if not tokens:
+        return value
+    
+    parent = resolve_json_pointer(document, tokens[:-1])
+
+    if isinstance(parent, list):
+        parent.insert(get_list_index(parent, tokens[-1], allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    else:
+        raise exceptions.ValidationError('No se puede agregar un valor aquí.')
+    
+    return document
+
+
+def remove_json_value(document, tokens):
+    if not tokens:
+        raise exceptions.ValidationError('No se puede eliminar el documento.')
+    
+    parent = resolve_json_pointer(document, tokens[:-1])
+
+    if isinstance(parent, list):
+        return parent.pop(get_list_index(parent, tokens[-1]))
+    
+    if isinstance(parent, dict) and tokens[-1] in parent:
+        return parent.pop(tokens[-1])
+    
+    raise exceptions.ValidationError(f'Ruta inexistente: /{tokens[-1]}')
+
+
+def apply_json_patch(document, operations):
+    """
+    Aplica las operaciones de un JSON Patch (RFC 6902) sobre una copia del
+    documento y la retorna. Si alguna operación falla, no se aplica ninguna.
+    """
+    if not isinstance(operations, list):
+        raise exceptions.ValidationError('El JSON Patch debe ser una lista.')
+    
+    document = copy.deepcopy(document)
+
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation:
+            raise exceptions.ValidationError('Operación inválida.')
+        
+        op = operation['op']
+        tokens = parse_json_pointer(operation.get('path'))
+
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise exceptions.ValidationError(f'Falta el valor de "{op}".')
+
+        if op == 'add':
+            document = add_json_value(document, tokens, operation['value'])
+
+        elif op == 'remove':
+            remove_json_value(document, tokens)
+
+        elif op == 'replace':
+            if tokens:
+                remove_json_value(document, tokens)
+            document = add_json_value(document, tokens, operation['value'])
+
+        elif op in ('move', 'copy'):
+            from_tokens = parse_json_pointer(operation.get('from'))
+
+            if op == 'move':
+                if tokens[:len(from_tokens)] == from_tokens and tokens != from_tokens:
+                    msg = 'No se puede mover un valor dentro de sí mismo.'
+                    raise exceptions.ValidationError(msg)
+                
+                value = remove_json_value(document, from_tokens)
+            else:
+                value = copy.deepcopy(resolve_json_pointer(document, from_tokens))
+
+            document = add_json_value(document, tokens, value)
+
+        elif op == 'test':
+            if resolve_json_pointer(document, tokens) != operation['value']:
+                msg = f'La prueba falló en {operation["path"]}.'
+                raise exceptions.ValidationError(msg)
+            
+        else:
+            raise exceptions.ValidationError(f'Operación desconocida: {op}')
+        
+    return document
+
+
+def apply_merge_patch(document, patch):
+    """
+    Aplica un JSON Merge Patch (RFC 7396): los valores null eliminan claves
+    y los objetos se combinan recursivamente.
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    
+    if not isinstance(document, dict):
+        document = {}
+    
+    result = dict(document)
+
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+
+    return result
+
+
+def overwrite_json_file(instance, content_json):
+    """
+    Reemplaza el contenido del archivo JSON de la rutina conservando su ruta.
+    """
+    try:
+        file_path = os.path.join(settings.MEDIA_ROOT, instance.json_rutina)
+        routine_cache.invalidate(instance.json_rutina)
+        old_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+        with atomic_write(file_path, 'w') as file:
+            json.dump(content_json, file, indent=4)
+
+        update_used_storage(
+            instance.autor, 
+            'routines', 
+            os.path.getsize(file_path) - old_size
+        )
+
+    except OSError as e:
+        print(f"Error en overwrite_json_file(): {e.strerror}") # debug
+        raise exceptions.ValidationError('Error en el servidor.')
+
+
+@transaction.atomic
+def patch_routine_instance(content_model, instance_id, patch, patch_type, version):
+    """
+    Función matriz que aplica una modificación parcial al JSON de la rutina.
+
+    La fila se bloquea (SELECT ... FOR UPDATE) mientras se aplica el parche,
+    por lo que dos parches simultáneos se aplican uno después del otro. Si
+    se indica la versión que tiene el cliente y la rutina ya cambió, se 
+    rechaza con 412 en vez de pisar los cambios de otra petición.
+
+    Parámetros:
+    - patch = Las operaciones (JSON Patch) o el documento parcial (Merge Patch)
+    - patch_type = 'json-patch' o 'merge-patch'
+    - version = La versión esperada de la rutina (o None para no verificarla)
+
+    Retorna la instancia actualizada y su nuevo documento.
+    """
+    instance = content_model.objects.select_for_update().get(pk=instance_id)
+
+    if version is not None and instance.version != version:
+        raise PreconditionFailed()
+    
+    document = get_routine_document(instance)
+
+    # Los documentos guardados como texto JSON se modifican ya decodificados
+    is_encoded = isinstance(document, str)
+
+    if is_encoded:
+        try:
+            document = json.loads(document)
+        except ValueError:
+            raise exceptions.ValidationError('El JSON de la rutina es inválido.')
+
+    if patch_type == 'json-patch':
+        document = apply_json_patch(document, patch)
+    else:
+        document = apply_merge_patch(document, patch)
+
+    if is_encoded:
+        document = json.dumps(document)
+
+    if settings.ROUTINE_DOCUMENTS_IN_DATABASE or not instance.json_rutina:
+        save_routine_document(
+            instance=instance, 
+            user_instance=instance.autor, 
+            content_name=instance.nombre, 
+            content_json=document
+        )
+    else:
+        overwrite_json_file(instance, document)
+        instance.documento = None
+
+    instance.version += 1
+    instance.save()
+
+    sync_routine_media_links(instance, document)
+
+    return instance, document
+
+
+# ------------------------------------------------------------------------------
+# Índice de pictogramas y audios usados en cada rutina
+# ------------------------------------------------------------------------------
+
+# Claves (en minúsculas y sin guiones bajos) que referencian un contenido por id
+MEDIA_REFERENCE_KEYS = {
+    'pictograma': (
+        'pictograma', 
+        'pictogramas', 
+        'pictogramaid', 
+        'idpictograma', 
+        'pictogram', 
+        'pictogramid',
+    ),
+    'audio': (
+        'audio', 
+        'audios', 
+        'audioid', 
+        'idaudio', 
+        'sonido', 
+        'sonidos', 
+        'sonidoid',
+    ),
+}
+
+# Carpetas de contenido dentro de las rutas de archivos referenciadas
+MEDIA_REFERENCE_FOLDERS = {
+    'pictograma': '/pictograms/',
+    'audio': '/sounds/',
+}
+
+
+def get_reference_path(value):
+    """
+    Retorna la ruta relativa a MEDIA_ROOT de una URL o ruta de un archivo
+    de contenido, o None si el valor no es una.
+    """
+    if settings.MEDIA_URL in value:
+        value = value.split(settings.MEDIA_URL, 1)[1]
+
+    value = value.lstrip('/')
+
+    if value.startswith(('user_content/', 'preloaded/', 'blobs/')):
+        return value
+    
+    return None
+
+
+def extract_media_references(document):
+    """
+    Recorre el JSON de la rutina y retorna, por tipo de contenido, los ids
+    y las rutas de archivo de los pictogramas y audios que referencia.
+    """
+    references = {
+        kind: {'ids': set(), 'paths': set()} 
+        for kind in MEDIA_REFERENCE_KEYS
+    }
+
+    # Muchos documentos se guardan como texto JSON dentro del JSON
+    while isinstance(document, str):
+        try:
+            document = json.loads(document)
+        except ValueError:
+            return references
+
+    pending = [(None, document)]
+
+    while pending:
+        key, value = pending.pop()
+        normalized_key = str(key).lower().replace('_', '')
+
+        if isinstance(value, dict):
+            for kind, keys in MEDIA_REFERENCE_KEYS.items():
+                if normalized_key in keys and 'id' in value:
+                    pending.append((kind, value['id']))
+
+            pending.extend(value.items())
+
+        elif isinstance(value, list):
+            pending.extend((key, item) for item in value)
+
+        elif isinstance(value, bool) or value is None:
+            continue
+
+        elif isinstance(value, (int, str)):
+            for kind, keys in MEDIA_REFERENCE_KEYS.items():
+                if normalized_key in keys and str(value).isdigit():
+                    references[kind]['ids'].add(int(value))
+
+            if isinstance(value, str):
+                path = get_reference_path(value)
+
+                if path is None:
+                    continue
+
+                for kind, folder in MEDIA_REFERENCE_FOLDERS.items():
+                    if folder in f'/{path}' or path.startswith('blobs/'):
+                        references[kind]['paths'].add(path)
+
+    return references
+
+
+def sync_routine_media_links(instance, document):
+    """
+    Reemplaza los vínculos de la rutina con los pictogramas y audios que 
+    referencia su JSON. Sólo se vincula contenido que el autor de la rutina
+    puede ver (propio o precargado). Debe llamarse dentro de la transacción
+    que guarda la rutina.
+    """
+    references = extract_media_references(document)
+    visible = Q(autor=instance.autor_id) | Q(es_precargado=True)
+    links = []
+
+    for kind, model in (('pictograma', Pictograma), ('audio', Audio)):
+        ids = references[kind]['ids']
+        paths = references[kind]['paths']
+
+        if not ids and not paths:
+            continue
+
+        content_ids = model.objects.filter(
+            Q(id__in=ids) | Q(ruta__in=paths), 
+            visible
+        ).values_list('id', flat=True)
+
+        links.extend(
+            RoutineMediaLink(rutina=instance, **{f'{kind}_id': content_id})
+            for content_id in content_ids
+        )
+
+    RoutineMediaLink.objects.filter(rutina=instance).delete()
+    RoutineMediaLink.objects.bulk_create(links)
+
+    return links
+
+
+def get_routine_media(instance):
+    """
+    Retorna los pictogramas y audios que referencia la rutina, según el 
+    índice: una consulta para los vínculos y una (id__in) por modelo.
+    """
+    pictogram_ids = set()
+    audio_ids = set()
+
+    for pictogram_id, audio_id in instance.media_links.values_list(
+        'pictograma_id', 
+        'audio_id'
+    ):
+        if pictogram_id:
+            pictogram_ids.add(pictogram_id)
+        if audio_id:
+            audio_ids.add(audio_id)
+
+    pictograms = Pictograma.objects.filter(id__in=pictogram_ids) \
+        if pictogram_ids else Pictograma.objects.none()
+    audios = Audio.objects.filter(id__in=audio_ids) \
+        if audio_ids else Audio.objects.none()
+
+    return pictograms.order_by('id'), audios.order_by('id')
+
+
+def get_content_usage(content_instance, user):
+    """
+    Retorna las rutinas que usan el pictograma o audio, con una sola 
+    consulta al índice. Los usuarios comunes sólo ven sus propias rutinas;
+    el staff ve todas (e.g. antes de eliminar contenido precargado).
+    """
+    kind = content_instance._meta.model_name
+    links = RoutineMediaLink.objects.filter(**{kind: content_instance.pk})
+
+    if not user.is_staff:
+        links = links.filter(rutina__autor=user.id)
+
+    routines = [
+        {'id': routine_id, 'nombre': name} 
+        for routine_id, name in links.order_by('rutina_id').values_list(
+            'rutina_id', 
+            'rutina__nombre'
+        )
+    ]
+
+    return {
+        'in_use': bool(routines),
+        'count': len(routines),
+        'rutinas': routines,
+    }
+
+
+# ------------------------------------------------------------------------------
+# Exportación e importación de rutinas (paquetes ZIP)
+# ------------------------------------------------------------------------------
+
+# Nombre del manifiesto dentro del paquete y carpeta de cada tipo de contenido
+BUNDLE_MANIFEST = 'rutina.json'
+
+BUNDLE_MEDIA = {
+    'pictogramas': ('pictograma', Pictograma, 'pictograms'),
+    'audios': ('audio', Audio, 'sounds'),
+}
+
+
+class ZipStreamBuffer:
+    """
+    Destino de escritura (sin seek) para zipfile: acumula los bytes escritos
+    hasta que el generador los entrega con pop().
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+    
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_routine_bundle(instance):
+    """
+    Prepara el paquete ZIP de la rutina antes de responder: el manifiesto 
+    'rutina.json' (con el JSON de la rutina) y los archivos a incluir (su 
+    portada y los pictogramas y audios que referencia). Los archivos que no
+    existen en el disco quedan en el manifiesto sin 'archivo'.
+
+    Así, los errores de la base de datos o del documento se informan con su
+    código de estado y no a mitad de la descarga.
+    """
+    pictograms, audios = get_routine_media(instance)
+    manifest = {
+        'formato': 1,
+        'nombre': instance.nombre,
+        'json_rutina': get_routine_document(instance),
+        'portada': None,
+        'pictogramas': [],
+        'audios': [],
+    }
+    files = []
+
+    if instance.url_portada:
+        _, extension = os.path.splitext(instance.url_portada.name)
+        manifest['portada'] = {'archivo': f'portada{extension}'}
+        files.append((instance.url_portada.name, manifest['portada']))
+
+    for key, contents in (('pictogramas', pictograms), ('audios', audios)):
+        for content in contents:
+            _, extension = os.path.splitext(content.ruta.name)
+            entry = {
+                'id': content.id,
+                'nombre': content.nombre,
+                'ruta': content.ruta.name,
+                'archivo': f'{key}/{content.id}{extension}',
+                'precargado': content.es_precargado,
+            }
+            manifest[key].append(entry)
+            files.append((content.ruta.name, entry))
+
+    bundle_files = []
+
+    for relative_path, entry in files:
+        file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+
+        if not os.path.isfile(file_path):
+            logger.warning(
+                'Rutina %s: %s no existe y se exporta sin ese archivo.', 
+                instance.id, 
+                file_path
+            )
+            entry['archivo'] = None
+            continue
+
+        bundle_files.append((file_path, entry))
+
+    return manifest, bundle_files
+
+
+def iter_routine_bundle(manifest, files):
+    """
+    Genera, por partes, el ZIP preparado con get_routine_bundle: cada archivo
+    y, al final, el manifiesto con el hash SHA-256 de cada uno. El ZIP nunca
+    se arma completo en memoria ni en disco; cada parte se entrega apenas se
+    escribe.
+    """
+    buffer = ZipStreamBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for file_path, entry in files:
+            digest = hashlib.sha256()
+
+            try:
+                source = open(file_path, 'rb')
+            except OSError as e:
+                # Eliminado después de preparar el paquete
+                logger.error('No se pudo agregar %s al paquete: %s', file_path, e)
+                entry['archivo'] = None
+                continue
+
+            with source, archive.open(entry['archivo'], 'w') as destination:
+                for chunk in iter(lambda: source.read(READ_SIZE), b''):
+                    digest.update(chunk)
+                    destination.write(chunk)
+                    yield buffer.pop()
+
+            entry['sha256'] = digest.hexdigest()
+
+        archive.writestr(
+            BUNDLE_MANIFEST, 
+            json.dumps(manifest, indent=4), 
+            compress_type=zipfile.ZIP_DEFLATED
+        )
+        yield buffer.pop()
+
+    yield buffer.pop()
+
+
+def hash_bundle_file(archive, name):
+    digest = hashlib.sha256()
+
+    with archive.open(name) as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def extract_bundle_file(archive, name, content_type):
+    """
+    Extrae un archivo del paquete a un archivo temporal, por partes, y lo
+    retorna como una subida más (que save_file mueve a su destino).
+    """
+    info = archive.getinfo(name)
+    file = TemporaryUploadedFile(
+        os.path.basename(name), 
+        content_type, 
+        info.file_size, 
+        None
+    )
+
+    with archive.open(name) as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            file.write(chunk)
+
+    file.seek(0)
+
+    return file
+
+
+def find_reusable_content(user, content_model, entry, file_hash, file_size):
+    """
+    Retorna un contenido ya existente idéntico al del paquete (mismo nombre
+    y mismo archivo) que el usuario puede usar, o None.
+
+    Con el almacenamiento por contenido se compara con el hash guardado en 
+    MediaBlob. El resto del contenido no guarda su hash, por lo que sólo se
+    leen los archivos del mismo nombre que además tienen el mismo tamaño.
+    """
+    candidates = content_model.objects.filter(
+        Q(autor=user.id) | Q(es_precargado=True), 
+        nombre=entry['nombre']
+    ).order_by('id')
+    blob_path = MediaBlob.objects.filter(hash=file_hash) \
+        .values_list('ruta', flat=True).first()
+
+    if blob_path is not None:
+        content = candidates.filter(ruta=blob_path).first()
+
+        if content is not None:
+            return content
+
+    for content in candidates.exclude(ruta__startswith='blobs/'):
+        file_path = os.path.join(settings.MEDIA_ROOT, content.ruta.name)
+
+        with suppress(OSError):
+            if os.path.getsize(file_path) != file_size:
+                continue
+
+            with open(file_path, 'rb') as f:
+                digest = hashlib.sha256()
+
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    digest.update(chunk)
+
+            if digest.hexdigest() == file_hash:
+                return content
+
+    return None
+
+
+def import_bundle_media(user, user_model, archive, key, entry, imported_paths):
+    """
+    Crea (o reutiliza) el pictograma o audio de un elemento del paquete y 
+    agrega la ruta de los que crea a imported_paths.
+
+    El hash se calcula sobre el archivo del paquete (no se confía en el del 
+    manifiesto). Si el usuario ya tiene acceso a un contenido idéntico, se 
+    reutiliza; si el blob ya existe en el almacenamiento por contenido, sólo
+    se registra una nueva referencia sin volver a escribir el archivo.
+    """
+    _, content_model, content_folder = BUNDLE_MEDIA[key]
+    file_hash = hash_bundle_file(archive, entry['archivo'])
+    file_size = archive.getinfo(entry['archivo']).file_size
+
+    content = find_reusable_content(
+        user, 
+        content_model, 
+        entry, 
+        file_hash, 
+        file_size
+    )
+
+    if content is not None:
+        return content
+    
+    if is_content_addressed(content_folder):
+        blob = reference_existing_blob(file_hash)
+
+        if blob is not None:
+            update_used_storage(user, content_folder, blob.size)
+            content = create_content_instance(
+                user_instance=user,
+                content_model=content_model,
+                content_name=entry['nombre'],
+                relative_path=blob.ruta
+            )
+            imported_paths.append(content.ruta.name)
+            schedule_media_processing(content)
+
+            return content
+    
+    file = extract_bundle_file(archive, entry['archivo'], entry['content_type'])
+
+    try:
+        content = create_content(
+            content_model=content_model,
+            user_model=user_model,
+            content_folder=content_folder,
+            validated_data={
+                'autor': user.id, 
+                'nombre': entry['nombre'], 
+                'ruta': file
+            }
+        )
+    finally:
+        file.close()
+
+    imported_paths.append(content.ruta.name)
+
+    return content
+
+
+def remove_imported_files(relative_paths):
+    """
+    Elimina los archivos de pictogramas y audios que escribió una importación
+    revertida, que quedaron sin registro en la base de datos. Un blob sólo se
+    elimina si nadie más lo registró (e.g. el contenido ya existía).
+    """
+    for relative_path in relative_paths:
+        if is_blob_path(relative_path):
+            file_hash, _ = os.path.splitext(os.path.basename(relative_path))
+            remove_unreferenced_blob(MediaBlob(hash=file_hash, ruta=relative_path))
+            continue
+
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(settings.MEDIA_ROOT, relative_path))
+
+        remove_derivatives(relative_path)
+
+
+def remap_media_references(document, id_maps, path_map):
+    """
+    Retorna una copia del JSON de la rutina con los ids y rutas de los 
+    pictogramas y audios del paquete reemplazados por los importados.
+    Mantiene la forma original del documento (e.g. texto JSON dentro de JSON).
+    """
+    encodings = 0
+
+    while isinstance(document, str):
+        try:
+            document = json.loads(document)
+            encodings += 1
+        except ValueError:
+            break
+
+    def remap(key, value):
+        normalized_key = str(key).lower().replace('_', '')
+        kinds = [
+            kind for kind, keys in MEDIA_REFERENCE_KEYS.items() 
+            if normalized_key in keys
+        ]
+
+        if isinstance(value, dict):
+            result = {k: remap(k, v) for k, v in value.items()}
+
+            for kind in kinds:
+                if 'id' in value:
+                    result['id'] = remap_id(kind, value['id'])
+
+            return result
+        
+        if isinstance(value, list):
+            return [remap(key, item) for item in value]
+        
+        if isinstance(value, bool) or value is None:
+            return value
+        
+        for kind in kinds:
+            value = remap_id(kind, value)
+
+        if isinstance(value, str):
+            path = get_reference_path(value)
+
+            if path in path_map:
+                value = value.replace(path, path_map[path])
+
+        return value
+    
+    def remap_id(kind, value):
+        if not str(value).isdigit() or int(value) not in id_maps[kind]:
+            return value
+        
+        new_id = id_maps[kind][int(value)]
+
+        return str(new_id) if isinstance(value, str) else new_id
+
+    document = remap(None, document)
+
+    for _ in range(encodings):
+        document = json.dumps(document)
+
+    return document
+
+
+def import_routine_bundle(user_model, validated_data):
+    """
+    Función matriz que crea una rutina a partir de un paquete exportado con
+    iter_routine_bundle(): primero sus pictogramas y audios (reutilizando 
+    los ya existentes), luego la portada y la rutina con las referencias 
+    actualizadas.
+
+    Si algo falla, la transacción no deja registros en la base de datos y 
+    se eliminan los archivos de los pictogramas y audios ya importados. Los
+    archivos que alcanzó a escribir create_routine (el JSON y la portada) 
+    quedan igual que al fallar la creación de una rutina; reconcile_storage
+    los informa como archivos sin referencia.
+
+    Parámetros:
+    - validated_data = Datos de RoutineBundleSerializer (autor, archive, 
+      manifest y, opcionalmente, reservation)
+    """
+    imported_paths = []
+
+    try:
+        return create_bundle_routine(user_model, validated_data, imported_paths)
+    except Exception:
+        remove_imported_files(imported_paths)
+        raise
+
+
+@transaction.atomic
+def create_bundle_routine(user_model, validated_data, imported_paths):
+    user = get_user_instance(validated_data['autor'], user_model)
+    archive = validated_data['archive']
+    manifest = validated_data['manifest']
+    id_maps = {kind: {} for kind, *_ in BUNDLE_MEDIA.values()}
+    path_map = {}
+
+    for key, (kind, *_) in BUNDLE_MEDIA.items():
+        for entry in manifest[key]:
+            content = import_bundle_media(
+                user, 
+                user_model, 
+                archive, 
+                key, 
+                entry, 
+                imported_paths
+            )
+            id_maps[kind][entry['id']] = content.id
+
+            if entry.get('ruta'):
+                path_map[entry['ruta']] = content.ruta.name
+
+    cover = None
+
+    if manifest['portada']:
+        cover = extract_bundle_file(
+            archive, 
+            manifest['portada']['archivo'], 
+            manifest['portada']['content_type']
+        )
+
+    try:
+        return create_routine(
+            content_model=Rutina,
+            user_model=user_model,
+            content_folder='covers',
+            validated_data={
+                'autor': user.id,
+                'nombre': manifest['nombre'],
+                'url_portada': cover,
+                'json_rutina': remap_media_references(
+                    manifest['json_rutina'], 
+                    id_maps, 
+                    path_map
+                ),
+                'reservation': validated_data.get('reservation'),
+            }
+        )
+    finally:
+        if cover is not None:
+            cover.close()
+
+
+# ------------------------------------------------------------------------------
+# Caché compartida del catálogo precargado
+# ------------------------------------------------------------------------------
+
+# Prefijo de las claves del catálogo en PRELOADED_CATALOG_CACHE
+PRELOADED_CATALOG_PREFIX = 'catalogo'
+
+
+def get_catalog_cache():
+    if not settings.PRELOADED_CATALOG_CACHE:
+        return None
+    
+    return caches[settings.PRELOADED_CATALOG_CACHE]
+
+
+def get_catalog_version(cache, model):
+    """
+    Retorna la versión actual del catálogo precargado del modelo, que forma
+    parte de la clave de su contenido serializado.
+    """
+    version_key = f'{PRELOADED_CATALOG_PREFIX}:{model._meta.label}:version'
+    version = cache.get(version_key)
+
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, None)
+        version = cache.get(version_key)
+
+    return version
+
+
+def bump_preloaded_catalog(model):
+    """
+    Invalida el catálogo precargado del modelo asignándole una nueva versión.
+    La versión es aleatoria, por lo que un contador perdido (e.g. expulsado
+    de la caché) nunca vuelve a apuntar a un catálogo anterior.
+    """
+    cache = get_catalog_cache()
+
+    if cache is None:
+        return
+    
+    version_key = f'{PRELOADED_CATALOG_PREFIX}:{model._meta.label}:version'
+    cache.set(version_key, uuid.uuid4().hex, None)
+
+
+def get_preloaded_catalog(model, request, serialize):
+    """
+    Retorna el contenido precargado del modelo ya serializado, desde la caché
+    compartida o bien serializándolo con serialize(queryset).
+
+    Ante un fallo de caché, sólo la petición que obtiene el bloqueo 
+    (cache.add) vuelve a armar el catálogo; las demás esperan a que esté
+    disponible, hasta PRELOADED_CATALOG_LOCK_TIMEOUT segundos.
+    """
+    queryset = model.objects.filter(es_precargado=True).order_by('id')
+    cache = get_catalog_cache()
+
+    if cache is None:
+        return serialize(queryset)
+    
+    # Las URLs serializadas son absolutas, por lo que dependen del host
+    base_url = request.build_absolute_uri('/')
+    host = hashlib.sha256(base_url.encode()).hexdigest()[:16]
+    version = get_catalog_version(cache, model)
+    payload_key = f'{PRELOADED_CATALOG_PREFIX}:{model._meta.label}:{version}:{host}'
+    lock_key = f'{payload_key}:lock'
+    lock_timeout = settings.PRELOADED_CATALOG_LOCK_TIMEOUT
+
+    payload = cache.get(payload_key)
+
+    if payload is not None:
+        return payload
+    
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            payload = serialize(queryset)
+            cache.set(payload_key, payload, settings.PRELOADED_CATALOG_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+
+        return payload
+    
+    deadline = time.monotonic() + lock_timeout
+
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        payload = cache.get(payload_key)
+
+        if payload is not None:
+            return payload
+        
+    # Quien armaba el catálogo no terminó a tiempo
+    return serialize(queryset)
+
+
+def get_content_list(model, request, serialize):
+    """
+    Retorna el listado completo de pictogramas o audios visible para el 
+    usuario: el catálogo precargado (compartido por todos los usuarios) más
+    su propio contenido, ordenados por id.
+    """
+    preloaded_content = get_preloaded_catalog(model, request, serialize)
+
+    if request.user.is_staff:
+        return preloaded_content
+    
+    user_content = serialize(
+        model.objects.filter(
+            autor=request.user.id, 
+            es_precargado=False
+        ).order_by('id')
+    )
+
+    return list(heapq.merge(
+        preloaded_content, 
+        user_content, 
+        key=lambda item: item['id']
+    ))
+
+
+# ------------------------------------------------------------------------------
+# Peticiones condicionales (ETag y Last-Modified)
+# ------------------------------------------------------------------------------
+
+def get_representation_digest(request, *values):
+    """
+    Resume en un hash los valores de los que depende la respuesta, junto con
+    el usuario, el formato y los parámetros de la petición (que también la 
+    modifican, e.g. ?cursor= o ?expand=).
+    """
+    parts = [
+        request.user.id,
+        request.accepted_renderer.format,
+        request.build_absolute_uri(),
+        *values,
+    ]
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    return digest[:32]
+
+
+def get_listing_validators(queryset, request):
+    """
+    Retorna el ETag y la fecha de última modificación de un listado con una
+    única consulta de agregación, sin serializar el contenido.
+
+    La cantidad de filas cubre las eliminaciones, que no cambian la fecha 
+    máxima.
+    """
+    aggregate = queryset.order_by().aggregate(
+        last_modified=Max('ultima_modificacion'),
+        total=Count('id')
+    )
+    etag = get_representation_digest(
+        request,
+        queryset.model._meta.label,
+        aggregate['total'],
+        aggregate['last_modified'],
+    )
+
+    return etag, aggregate['last_modified']
+
+
+def get_routine_validators(queryset, routine_id, request):
+    """
+    Retorna el ETag y la fecha de última modificación de una rutina, o 
+    (None, None) si no existe.
+
+    El ETag comienza con la versión de la rutina, por lo que también sirve
+    como If-Match de un PATCH. Con ?expand=media incluye además el estado de
+    los pictogramas y audios que se agregan a la respuesta.
+    """
+    try:
+        routine = queryset.filter(pk=routine_id).values(
+            'version', 
+            'ultima_modificacion'
+        ).first()
+    except (TypeError, ValueError):
+        routine = None
+
+    if routine is None:
+        return None, None
+    
+    values = [routine['version'], routine['ultima_modificacion']]
+    expand = request.query_params.get('expand', '').split(',')
+
+    if 'media' in expand:
+        media = RoutineMediaLink.objects.filter(rutina=routine_id).aggregate(
+            pictograms=Max('pictograma__ultima_modificacion'),
+            audios=Max('audio__ultima_modificacion'),
+            total=Count('id')
+        )
+        values += [media['pictograms'], media['audios'], media['total']]
+
+    etag = f'{routine["version"]}-{get_representation_digest(request, *values)}'
+
+    return etag, routine['ultima_modificacion']
+
+
+def get_not_modified_response(request, etag, last_modified):
+    """
+    Retorna una respuesta 304 si el cliente ya tiene la versión actual 
+    (If-None-Match / If-Modified-Since), o None si hay que responder 
+    normalmente.
+    """
+    if etag is None:
+        return None
+    
+    response = get_conditional_response(
+        request,
+        etag=quote_etag(etag),
+        last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+
+    if response is not None:
+        set_conditional_headers(response, etag, last_modified)
+
+    return response
+
+
+def set_conditional_headers(response, etag, last_modified):
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+
+    return response
+
+
+# ------------------------------------------------------------------------------
+# Sincronización incremental
+# ------------------------------------------------------------------------------
+
+def encode_sync_token(moment):
+    token = base64.urlsafe_b64encode(moment.isoformat().encode('utf-8'))
+    return token.decode('ascii')
+
+
+def decode_sync_token(token):
+    try:
+        moment = datetime.fromisoformat(base64.urlsafe_b64decode(token).decode())
+    except (TypeError, ValueError):
+        raise exceptions.ValidationError('Token de sincronización inválido.')
+    
+    if timezone.is_naive(moment):
+        raise exceptions.ValidationError('Token de sincronización inválido.')
+
+    return moment
+
+
+def get_sync_token():
+    """
+    Retorna el token de la próxima sincronización: la hora actual menos 
+    SYNC_TOKEN_MARGIN segundos, para no perder cambios de transacciones que
+    aún no se confirmaban. Algunos cambios pueden llegar dos veces, por lo
+    que el cliente debe aplicarlos de forma idempotente.
+    """
+    moment = timezone.now() - timedelta(seconds=settings.SYNC_TOKEN_MARGIN)
+    return encode_sync_token(moment)
+
+
+def get_changed_content(model, request, since):
+    """
+    Retorna el contenido visible para el usuario creado o modificado desde 
+    'since' (todo el contenido si 'since' es None).
+    """
+    queryset = get_queryset_by_user_type(model=model, request=request)
+
+    if since is not None:
+        queryset = queryset.filter(ultima_modificacion__gte=since)
+
+    return queryset.order_by('ultima_modificacion', 'id')
+
+
+def get_deleted_content_ids(model, user, since):
+    """
+    Retorna los ids del contenido visible para el usuario eliminado desde 
+    'since', según los registros de eliminación ('-') del historial.
+    """
+    if since is None:
+        return []
+    
+    deletions = model.log.model.objects.filter(
+        history_type='-', 
+        history_date__gte=since
+    )
+
+    if model._meta.verbose_name == 'Rutina':
+        deletions = deletions.filter(autor_id=user.id)
+    elif user.is_staff:
+        deletions = deletions.filter(es_precargado=True)
+    else:
+        deletions = deletions.filter(Q(es_precargado=True) | Q(autor_id=user.id))
+
+    return sorted(set(deletions.values_list('id', flat=True)))
+
+
+# ------------------------------------------------------------------------------
+# Búsqueda por nombre
+# ------------------------------------------------------------------------------
+
+def search_content_by_name(queryset, query):
+    """
+    Filtra el contenido cuyo nombre contiene el texto buscado. En PostgreSQL
+    la búsqueda usa el índice de trigramas de nombre_normalizado.
+    """
+    query = normalize_name(query)
+
+    if not query:
+        return queryset
+    
+    return queryset.filter(nombre_normalizado__contains=query)
+
+
+def get_name_suggestions(queryset, query, limit=None):
+    """
+    Retorna id y nombre del contenido cuyo nombre comienza con el texto 
+    buscado (autocompletado), en orden alfabético. Usa el índice por prefijo
+    de nombre_normalizado y no serializa el contenido completo.
+    """
+    query = normalize_name(query)
+
+    if not query:
+        return []
+    
+    try:
+        limit = int(limit) if limit else settings.AUTOCOMPLETE_LIMIT
+    except ValueError:
+        raise exceptions.ValidationError('Límite inválido.')
+    
+    limit = min(max(limit, 1), settings.AUTOCOMPLETE_MAX_LIMIT)
+
+    return list(
+        queryset.filter(nombre_normalizado__startswith=query)
+        .order_by('nombre_normalizado', 'id')
+        .values('id', 'nombre', 'es_precargado')[:limit]
+    )
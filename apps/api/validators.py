@@ -7,7 +7,7 @@ from django.contrib.auth.password_validation import get_default_password_validat
 
 from rest_framework.exceptions import ValidationError, UnsupportedMediaType, NotFound
 
-from .utils import get_used_storage
+from .utils import get_storage_ledger
 
 
 class DNSBLVerifier():
@@ -72,36 +72,62 @@ def use_default_password_validators(password):
 
 def verify_file_type(value, content_type):
     if value:
-        if content_type == 'Pictograma' or content_type == 'Rutina':
-            if value.content_type not in ['image/png', 'image/jpg', 'image/jpeg']:
-                raise UnsupportedMediaType('Formato de archivo no válido.')
-        elif content_type == 'Audio':
-            if value.content_type not in ['audio/mpeg', 'audio/wav']:
-                raise UnsupportedMediaType('Formato de archivo no válido.')
+        verify_mime_type(value.content_type, content_type)
     
     return value
 
 
+def verify_mime_type(mime_type, content_type):
+    if content_type == 'Pictograma' or content_type == 'Rutina':
+        if mime_type not in ['image/png', 'image/jpg', 'image/jpeg']:
+            raise UnsupportedMediaType('Formato de archivo no válido.')
+    elif content_type == 'Audio':
+        if mime_type not in ['audio/mpeg', 'audio/wav']:
+            raise UnsupportedMediaType('Formato de archivo no válido.')
+        
+    return mime_type
+
+
 def verify_file_size(value, user):
-    if value.size > 1024 * 1024:  # 1 MB
+    verify_upload_size(value.size, user)
+    
+    return value
+
+
+def verify_upload_size(size, user):
+    verify_max_file_size(size)
+    verify_remaining_storage(size, user)
+
+    return size
+
+
+def verify_max_file_size(size):
+    if size > 1024 * 1024:  # 1 MB
         msg = 'Tamaño de archivo demasiado grande.'
         raise ValidationError(msg)
     
-    verify_remaining_storage_for_file(value, user)
+    return size
+
+
+def verify_remaining_storage_for_file(value, user):
+    verify_remaining_storage(value.size, user)
     
     return value
 
 
-def verify_remaining_storage_for_file(value, user):
+def verify_remaining_storage(size, user):
     storage_limit = user.storage_limit
-    used_storage = get_used_storage(user.id)
+    ledger = get_storage_ledger(user.id)
+
+    # Incluye lo reservado por otras subidas en curso del mismo usuario
+    used_storage = ledger.used_storage + ledger.reserved_storage
     remaining_storage = max(0, storage_limit - used_storage)
 
-    if remaining_storage <= 0 or value.size >= remaining_storage:
+    if remaining_storage <= 0 or size >= remaining_storage:
         msg = 'No hay espacio suficiente para almacenar este archivo.'
         raise ValidationError(msg)
     
-    return value
+    return size
 
 
 def verify_content_name(value):
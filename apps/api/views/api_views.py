@@ -7,11 +7,17 @@ from django.http import FileResponse
 from rest_framework import exceptions, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 
-from ..models import User
+from ..models import User, Pictograma, Audio, Rutina
 from ..serializers import ContactFormSerializer
-from ..utils import get_used_storage
+from ..serializers import PictogramaReadSerializer, AudioReadSerializer
+from ..serializers import RutinaReadSerializer
+from ..utils import get_storage_ledger
+from ..utils import routine_cache
+from ..utils import get_routine_document
+from ..utils import decode_sync_token, get_sync_token
+from ..utils import get_changed_content, get_deleted_content_ids
 
 
 class UserStorageView(APIView):
@@ -26,18 +32,79 @@ class UserStorageView(APIView):
             raise exceptions.NotFound(message)
         
         storage_limit = user.storage_limit
-        used_storage = get_used_storage(user.id)
+        ledger = get_storage_ledger(user.id)
+        used_storage = ledger.used_storage
         remaining_storage = max(0, storage_limit - used_storage)
 
         data = {
             'storage_limit': storage_limit,
             'used_storage': used_storage,
-            'remaining_storage': remaining_storage
+            'remaining_storage': remaining_storage,
+            'used_storage_by_type': {
+                'pictograms': ledger.pictograms_size,
+                'sounds': ledger.sounds_size,
+                'covers': ledger.covers_size,
+                'routines': ledger.routines_size,
+            }
         }
 
         return Response(data)
     
 
+class RoutineCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(routine_cache.stats(), status=status.HTTP_200_OK)
+    
+
+class SyncView(APIView):
+    """
+    Sincronización incremental para clientes sin conexión: con ?since=<token>
+    retorna sólo los pictogramas, audios y rutinas creados o modificados 
+    desde la sincronización anterior, más los ids de los eliminados, y el 
+    token de la siguiente. Sin 'since' retorna todo el contenido.
+    """
+    permission_classes = [IsAuthenticated]
+    sync_models = (
+        ('pictogramas', Pictograma, PictogramaReadSerializer),
+        ('audios', Audio, AudioReadSerializer),
+        ('rutinas', Rutina, RutinaReadSerializer),
+    )
+
+    def get(self, request, *args, **kwargs):
+        since = request.query_params.get('since')
+        since = decode_sync_token(since) if since else None
+
+        # El token se calcula antes de consultar, para no perder cambios
+        data = {'token': get_sync_token()}
+
+        for key, model, serializer_class in self.sync_models:
+            changed = get_changed_content(model, request, since)
+
+            # Las rutinas necesitan además su documento
+            if model is not Rutina:
+                changed = changed.only(*serializer_class.projection)
+
+            serializer = serializer_class(
+                changed, 
+                many=True, 
+                context={'request': request}
+            )
+            changed_data = serializer.data
+
+            if model is Rutina:
+                for instance, item in zip(changed, changed_data):
+                    item['json_rutina'] = get_routine_document(instance)
+
+            data[key] = {
+                'changed': changed_data,
+                'deleted': get_deleted_content_ids(model, request.user, since),
+            }
+
+        return Response(data, status=status.HTTP_200_OK)
+    
+
 class ContactFormView(APIView):
     def post(self, request, *args, **kwargs):
         try:
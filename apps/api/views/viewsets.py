@@ -1,24 +1,61 @@
-import os
-import json
+from itertools import chain
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from django.http import StreamingHttpResponse
 
 from rest_framework import exceptions, status, viewsets
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
+from apps.api.pagination import ContentCursorPagination
+from apps.api.parsers import JSONPatchParser, MergePatchParser
+
 from apps.api.serializers import UserSerializer
 from apps.api.serializers import PictogramaSerializer
 from apps.api.serializers import AudioSerializer
 from apps.api.serializers import RutinaSerializer
+from apps.api.serializers import PictogramaReadSerializer
+from apps.api.serializers import AudioReadSerializer
+from apps.api.serializers import RutinaReadSerializer
+from apps.api.serializers import UploadSessionSerializer
+from apps.api.serializers import ContentBatchSerializer
+from apps.api.serializers import RoutineBundleSerializer
 
 from apps.api.utils import get_queryset_by_user_type
+from apps.api.utils import get_content_list
+from apps.api.utils import search_content_by_name
+from apps.api.utils import get_name_suggestions
+from apps.api.utils import get_listing_validators
+from apps.api.utils import get_routine_validators
+from apps.api.utils import get_not_modified_response
+from apps.api.utils import set_conditional_headers
 from apps.api.utils import remove_instance_file
 from apps.api.utils import remove_cover_file
 from apps.api.utils import remove_json_file
+from apps.api.utils import get_routine_document
+from apps.api.utils import get_routine_document_chunks
+from apps.api.utils import patch_routine_instance
+from apps.api.utils import get_content_usage
+from apps.api.utils import get_routine_media
+from apps.api.utils import get_routine_bundle
+from apps.api.utils import iter_routine_bundle
+from apps.api.utils import get_upload_size
+from apps.api.utils import StorageReservation
+from apps.api.utils import write_upload_chunk
+from apps.api.utils import create_upload_session
+from apps.api.utils import get_upload_session_file
+from apps.api.utils import release_upload_reservation
+from apps.api.utils import remove_upload_session
+from apps.api.utils import remove_expired_upload_sessions
+from apps.api.utils import get_batch_results
 
 
 # ----- User -----
@@ -79,36 +116,124 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-# ----- Pictograma ----- OK
-class PictogramaViewSet(viewsets.ModelViewSet):
-    authentication_classes = [JWTAuthentication]
-    permission_classes = [IsAuthenticated]
-    serializer_class = PictogramaSerializer
-    parser_classes = (MultiPartParser, FormParser)
-    model = serializer_class.Meta.model
+# ----- Lectura de contenido -----
+class ContentReadMixin:
+    """
+    Lectura común de pictogramas, audios y rutinas: el listado usa el 
+    serializador de lectura con ?fields= (cargando sólo esas columnas), 
+    responde 304 según el ETag y se pagina por cursor.
+    """
+    read_serializer_class = None
+    pagination_class = ContentCursorPagination
 
-    # ----- get_queryset ----- OK
+    # Búsqueda por nombre con ?q= al listar
+    search_by_name = False
+
+    # El listado completo sale del catálogo precargado en caché
+    preloaded_catalog = False
+
+    # ----- get_queryset -----
     def get_queryset(self):
         queryset = get_queryset_by_user_type(
             model=self.model, 
             request=self.request
         )
 
-        return queryset
+        if self.action != 'list':
+            return queryset
+
+        # Búsqueda por nombre, sin distinguir mayúsculas ni acentos
+        if self.search_by_name and self.request.query_params.get('q'):
+            queryset = search_content_by_name(
+                queryset, 
+                self.request.query_params['q']
+            )
+
+        # Carga sólo las columnas de los campos que se entregan
+        return queryset.only(
+            *self.read_serializer_class.get_projection(self.get_sparse_fields())
+        )
     
-    # ----- list ----- OK
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
+    # ----- get_serializer_class -----
+    def get_serializer_class(self):
+        if self.action in ('list', 'retrieve'):
+            return self.read_serializer_class
         
-        return Response(
-            serializer.data, 
-            status=status.HTTP_200_OK,
+        return self.serializer_class
+    
+    # ----- get_serializer -----
+    def get_serializer(self, *args, **kwargs):
+        if self.action == 'list':
+            kwargs.setdefault('fields', self.get_sparse_fields())
+
+        return super().get_serializer(*args, **kwargs)
+    
+    # ----- get_sparse_fields -----
+    def get_sparse_fields(self):
+        """
+        Campos pedidos con ?fields= al listar (None si se piden todos).
+        """
+        return self.read_serializer_class.parse_fields(
+            self.request.query_params.get('fields')
         )
     
+    # ----- list -----
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+
+        # 304 sin serializar si el listado no cambió
+        etag, last_modified = get_listing_validators(queryset, request)
+        response = get_not_modified_response(request, etag, last_modified)
+
+        if response is not None:
+            return response
+
+        page = self.paginate_queryset(queryset)
+
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+
+        elif self.preloaded_catalog and settings.PRELOADED_CATALOG_CACHE \
+                and not request.query_params.get('q'):
+            # El catálogo en caché tiene todos los campos
+            data = get_content_list(
+                self.model, 
+                request, 
+                lambda queryset: self.get_serializer(
+                    queryset.only(*self.read_serializer_class.projection), 
+                    many=True,
+                    fields=None
+                ).data
+            )
+            data = self.read_serializer_class.narrow(data, self.get_sparse_fields())
+            response = Response(data, status=status.HTTP_200_OK)
+
+        else:
+            serializer = self.get_serializer(queryset, many=True)
+            response = Response(serializer.data, status=status.HTTP_200_OK)
+
+        if page is None:
+            # Listado completo, sólo con CONTENT_LEGACY_UNPAGINATED
+            response['Deprecation'] = 'true'
+        
+        return set_conditional_headers(response, etag, last_modified)
+
+
+# ----- Pictograma ----- OK
+class PictogramaViewSet(ContentReadMixin, viewsets.ModelViewSet):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = PictogramaSerializer
+    read_serializer_class = PictogramaReadSerializer
+    search_by_name = True
+    preloaded_catalog = True
+    parser_classes = (MultiPartParser, FormParser)
+    model = serializer_class.Meta.model
+
     # ----- perform_create ----- OK
-    def perform_create(self, serializer):
-        serializer.save(autor=self.request.user.id)
+    def perform_create(self, serializer, reservation=None):
+        serializer.save(autor=self.request.user.id, reservation=reservation)
     
     # ----- create ----- OK
     def create(self, request, *args, **kwargs):
@@ -123,12 +248,22 @@ class PictogramaViewSet(viewsets.ModelViewSet):
         serializer = self.serializer_class(data=data)
         serializer.is_valid(raise_exception=True)
 
-        self.perform_create(serializer)
+        # Reserva el espacio de la subida hasta que el contenido quede creado
+        file_size = get_upload_size(data['ruta'])
+
+        with StorageReservation(request.user, file_size) as reservation:
+            self.perform_create(serializer, reservation)
         headers = self.get_success_headers(serializer.data)
 
+        # 202 si las miniaturas quedaron pendientes en la cola de tareas
+        if serializer.data['estado'] == 'pendiente':
+            status_code = status.HTTP_202_ACCEPTED
+        else:
+            status_code = status.HTTP_201_CREATED
+
         return Response(
             serializer.data, 
-            status=status.HTTP_201_CREATED, 
+            status=status_code, 
             headers=headers,
         )
     
@@ -175,6 +310,7 @@ class PictogramaViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     # ----- destroy ----- OK
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         remove_instance_file(instance)
@@ -183,35 +319,76 @@ class PictogramaViewSet(viewsets.ModelViewSet):
         msg = {'message': 'Content deleted successfully.'}
 
         return Response(msg, status=status.HTTP_200_OK)
+
+    # ----- batch -----
+    @action(detail=False, methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        if not request.data:
+            raise exceptions.NotFound('No hay datos en la petición.')
+        
+        data = {
+            'files': request.data.getlist('files'),
+            'names': request.data.getlist('names'),
+            'autor': self.request.user.id,
+        }
+        serializer = ContentBatchSerializer(
+            data=data, 
+            content_model=self.model, 
+            content_folder='pictograms'
+        )
+        serializer.is_valid(raise_exception=True)
+
+        # Reserva de una vez el espacio de todo el lote
+        file_size = sum(
+            get_upload_size(item['ruta']) 
+            for item in serializer.validated_data['items']
+        )
+
+        with StorageReservation(request.user, file_size) as reservation:
+            instances = serializer.save(reservation=reservation)
+
+        results, status_code = get_batch_results(
+            instances=instances, 
+            validated_data=serializer.validated_data, 
+            serializer=self.get_serializer
+        )
+
+        return Response(results, status=status_code)
+
+    # ----- usage -----
+    @action(detail=True, methods=['get'])
+    def usage(self, request, *args, **kwargs):
+        instance = self.get_object()
+        data = get_content_usage(instance, request.user)
+
+        return Response(data, status=status.HTTP_200_OK)
+    
+    # ----- autocomplete -----
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request, *args, **kwargs):
+        data = get_name_suggestions(
+            self.get_queryset(), 
+            request.query_params.get('q', ''),
+            request.query_params.get('limit')
+        )
+
+        return Response(data, status=status.HTTP_200_OK)
             
             
 # ----- Audio -----
-class AudioViewSet(viewsets.ModelViewSet):
+class AudioViewSet(ContentReadMixin, viewsets.ModelViewSet):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = AudioSerializer
+    read_serializer_class = AudioReadSerializer
+    search_by_name = True
+    preloaded_catalog = True
     parser_classes = (MultiPartParser, FormParser)
     model = serializer_class.Meta.model
 
-    # ----- get_queryset ----- OK
-    def get_queryset(self):
-        queryset = get_queryset_by_user_type(
-            model=self.model, 
-            request=self.request
-        )
-
-        return queryset
-    
-    # ----- list ----- OK
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        
-        return Response(serializer.data, status=status.HTTP_200_OK)
-    
     # ----- perform_create ----- OK
-    def perform_create(self, serializer):
-        serializer.save(autor=self.request.user.id)
+    def perform_create(self, serializer, reservation=None):
+        serializer.save(autor=self.request.user.id, reservation=reservation)
 
     # ----- create ----- OK
     def create(self, request, *args, **kwargs):
@@ -226,7 +403,11 @@ class AudioViewSet(viewsets.ModelViewSet):
         serializer = self.serializer_class(data=data)
         serializer.is_valid(raise_exception=True)
 
-        self.perform_create(serializer)
+        # Reserva el espacio de la subida hasta que el contenido quede creado
+        file_size = get_upload_size(data['ruta'])
+
+        with StorageReservation(request.user, file_size) as reservation:
+            self.perform_create(serializer, reservation)
 
         headers = self.get_success_headers(serializer.data)
         status_code = status.HTTP_201_CREATED
@@ -277,6 +458,7 @@ class AudioViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     # ----- destroy ----- OK
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         remove_instance_file(instance)
@@ -285,28 +467,91 @@ class AudioViewSet(viewsets.ModelViewSet):
         msg = {'message': 'Content deleted successfully.'}
         
         return Response(msg, status=status.HTTP_200_OK)
+
+    # ----- batch -----
+    @action(detail=False, methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        if not request.data:
+            raise exceptions.NotFound('No hay datos en la petición.')
+        
+        data = {
+            'files': request.data.getlist('files'),
+            'names': request.data.getlist('names'),
+            'autor': self.request.user.id,
+        }
+        serializer = ContentBatchSerializer(
+            data=data, 
+            content_model=self.model, 
+            content_folder='sounds'
+        )
+        serializer.is_valid(raise_exception=True)
+
+        # Reserva de una vez el espacio de todo el lote
+        file_size = sum(
+            get_upload_size(item['ruta']) 
+            for item in serializer.validated_data['items']
+        )
+
+        with StorageReservation(request.user, file_size) as reservation:
+            instances = serializer.save(reservation=reservation)
+
+        results, status_code = get_batch_results(
+            instances=instances, 
+            validated_data=serializer.validated_data, 
+            serializer=self.get_serializer
+        )
+
+        return Response(results, status=status_code)
+
+    # ----- usage -----
+    @action(detail=True, methods=['get'])
+    def usage(self, request, *args, **kwargs):
+        instance = self.get_object()
+        data = get_content_usage(instance, request.user)
+
+        return Response(data, status=status.HTTP_200_OK)
+    
+    # ----- autocomplete -----
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request, *args, **kwargs):
+        data = get_name_suggestions(
+            self.get_queryset(), 
+            request.query_params.get('q', ''),
+            request.query_params.get('limit')
+        )
+
+        return Response(data, status=status.HTTP_200_OK)
     
 
 # ----- Rutina -----
-class RutinaViewSet(viewsets.ModelViewSet):
+class RutinaViewSet(ContentReadMixin, viewsets.ModelViewSet):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = RutinaSerializer
-    parser_classes = (MultiPartParser, FormParser)
+    read_serializer_class = RutinaReadSerializer
+    parser_classes = (
+        MultiPartParser, 
+        FormParser, 
+        JSONPatchParser, 
+        MergePatchParser
+    )
     model = serializer_class.Meta.model
 
     # ----- get_queryset ----- OK
     def get_queryset(self):
-        queryset = get_queryset_by_user_type(
-            model=self.model, 
-            request=self.request
-        )
+        queryset = super().get_queryset()
+
+        # Trae el documento de la base de datos como texto, sin decodificarlo
+        if self.action == 'retrieve' and settings.ROUTINE_JSON_PASSTHROUGH:
+            queryset = queryset.defer('documento').annotate(
+                documento_raw=Cast('documento', output_field=TextField())
+            )
 
         return queryset
     
     # ----- perform_create ----- OK
-    def perform_create(self, serializer):
-        serializer.save(autor=self.request.user.id)
+    def perform_create(self, serializer, reservation=None):
+        serializer.save(autor=self.request.user.id, reservation=reservation)
     
     # ----- create ----- OK
     def create(self, request, *args, **kwargs):
@@ -326,30 +571,110 @@ class RutinaViewSet(viewsets.ModelViewSet):
         serializer = self.serializer_class(data=data)
         serializer.is_valid(raise_exception=True)
 
-        self.perform_create(serializer)
+        # Reserva el espacio de la subida hasta que el contenido quede creado
+        file_size = get_upload_size(data['url_portada'])
+
+        with StorageReservation(request.user, file_size) as reservation:
+            self.perform_create(serializer, reservation)
 
         headers = self.get_success_headers(serializer.data)
-        status_code = status.HTTP_201_CREATED
+
+        # 202 si las miniaturas quedaron pendientes en la cola de tareas
+        if serializer.data['estado'] == 'pendiente':
+            status_code = status.HTTP_202_ACCEPTED
+        else:
+            status_code = status.HTTP_201_CREATED
 
         return Response(serializer.data, status=status_code, headers=headers)
     
     # ----- retrieve ----- OK
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
+        # 304 sin leer el documento si la rutina no cambió
+        etag, last_modified = get_routine_validators(
+            get_queryset_by_user_type(model=self.model, request=request),
+            kwargs['pk'],
+            request
+        )
+        response = get_not_modified_response(request, etag, last_modified)
 
-        json_file_path = os.path.join(settings.MEDIA_ROOT, instance.json_rutina)
+        if response is not None:
+            return response
 
-        try:
-            with open(json_file_path, 'r') as json_file:
-                json_content = json.load(json_file)
-        except:
-            raise exceptions.NotFound('No se ha encontrado el JSON de la rutina.')
+        instance = self.get_object()
+
+        if settings.ROUTINE_JSON_PASSTHROUGH and \
+        request.accepted_renderer.format == 'json':
+            response = self.retrieve_passthrough(instance)
+            return set_conditional_headers(response, etag, last_modified)
+        
+        json_content = get_routine_document(instance)
 
         serializer = self.get_serializer(instance)
         response_data = serializer.data
         response_data['json_rutina'] = json_content
+        self.add_expanded_media(instance, response_data)
+
+        response = Response(response_data, status=status.HTTP_200_OK)
+
+        return set_conditional_headers(response, etag, last_modified)
+    
+    # ----- add_expanded_media -----
+    def add_expanded_media(self, instance, response_data):
+        """
+        Con ?expand=media, agrega a la respuesta los pictogramas y audios que 
+        usa la rutina (con sus miniaturas), para que el cliente no tenga que
+        pedirlos uno por uno.
+        """
+        expand = self.request.query_params.get('expand', '').split(',')
+
+        if 'media' not in expand:
+            return response_data
+        
+        pictograms, audios = get_routine_media(instance)
+        context = self.get_serializer_context()
+
+        # Serializadores de lectura sobre consultas que cargan sólo sus columnas
+        pictograms = pictograms.only(*PictogramaReadSerializer.get_projection())
+        audios = audios.only(*AudioReadSerializer.get_projection())
+
+        response_data['media'] = {
+            'pictogramas': PictogramaReadSerializer(
+                pictograms, 
+                many=True, 
+                context=context
+            ).data,
+            'audios': AudioReadSerializer(
+                audios, 
+                many=True, 
+                context=context
+            ).data,
+        }
+
+        return response_data
+    
+    # ----- retrieve_passthrough -----
+    def retrieve_passthrough(self, instance):
+        """
+        Igual que retrieve, pero inserta los bytes del JSON guardado 
+        directamente en el cuerpo de la respuesta, junto a los demás campos 
+        serializados, por lo que su costo no crece con el tamaño de la rutina.
+        """
+        document_chunks = get_routine_document_chunks(instance)
 
-        return Response(response_data, status=status.HTTP_200_OK)
+        serializer = self.get_serializer(instance)
+        response_data = dict(serializer.data)
+        response_data.pop('json_rutina', None)
+        self.add_expanded_media(instance, response_data)
+
+        # '{"id": ..., "nombre": ...' + ',"json_rutina":' + <JSON> + '}'
+        fields = JSONRenderer().render(response_data)
+        prefix = fields[:-1] + b',"json_rutina":'
+
+        return StreamingHttpResponse(
+            chain([prefix], document_chunks, [b'}']),
+            content_type='application/json',
+            status=status.HTTP_200_OK,
+        )
     
     # ----- update -----
     def update(self, request, *args, **kwargs):
@@ -391,7 +716,59 @@ class RutinaViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data, status=status.HTTP_200_OK)
     
+    # ----- partial_update -----
+    def partial_update(self, request, *args, **kwargs):
+        """
+        PATCH con un cuerpo JSON Patch o JSON Merge Patch modifica sólo las 
+        partes indicadas del JSON de la rutina. El header If-Match (con el 
+        ETag de retrieve o de un PATCH anterior) evita pisar cambios hechos 
+        por otra petición.
+        Cualquier otro cuerpo se trata como una actualización normal.
+        """
+        patch_types = {
+            JSONPatchParser.media_type: 'json-patch',
+            MergePatchParser.media_type: 'merge-patch',
+        }
+        media_type = (request.content_type or '').split(';')[0].strip()
+
+        if media_type not in patch_types:
+            return super().partial_update(request, *args, **kwargs)
+        
+        instance = self.get_object()
+        version = request.headers.get('If-Match')
+
+        if version is not None:
+            try:
+                # Acepta también el ETag de retrieve ("<versión>-<hash>")
+                version = version.strip().removeprefix('W/').strip('"')
+                version = int(version.split('-')[0])
+            except ValueError:
+                raise exceptions.ValidationError('Header If-Match inválido.')
+
+        instance, document = patch_routine_instance(
+            content_model=self.model,
+            instance_id=instance.pk,
+            patch=request.data,
+            patch_type=patch_types[media_type],
+            version=version
+        )
+
+        serializer = self.get_serializer(instance)
+        response_data = serializer.data
+        response_data['json_rutina'] = document
+
+        # Mismo ETag que entrega retrieve para la nueva versión
+        etag, last_modified = get_routine_validators(
+            get_queryset_by_user_type(model=self.model, request=request),
+            instance.pk,
+            request
+        )
+        response = Response(response_data, status=status.HTTP_200_OK)
+
+        return set_conditional_headers(response, etag, last_modified)
+    
     # ----- destroy -----
+    @transaction.atomic
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
         remove_json_file(instance)
@@ -401,3 +778,217 @@ class RutinaViewSet(viewsets.ModelViewSet):
         msg = {'message': 'Content deleted successfully.'}
         
         return Response(msg, status=status.HTTP_200_OK)
+    
+    # ----- export -----
+    @action(detail=True, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        """
+        Descarga la rutina, su portada y los pictogramas y audios que usa
+        en un ZIP, generado a medida que se envía.
+        """
+        instance = self.get_object()
+        manifest, files = get_routine_bundle(instance)
+
+        response = StreamingHttpResponse(
+            iter_routine_bundle(manifest, files),
+            content_type='application/zip',
+            status=status.HTTP_200_OK,
+        )
+        response['Content-Disposition'] = \
+            f'attachment; filename="rutina_{instance.id}.zip"'
+
+        return response
+    
+    # ----- import_bundle -----
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_bundle(self, request, *args, **kwargs):
+        """
+        Crea una rutina a partir de un ZIP descargado con export. Los 
+        pictogramas y audios idénticos (mismo nombre y archivo) a los propios
+        o precargados se reutilizan en lugar de volver a guardarse.
+        """
+        if not request.data:
+            raise exceptions.NotFound('No hay datos en la petición.')
+        
+        data = {
+            'file': request.data.get('file'),
+            'autor': self.request.user.id,
+        }
+        serializer = RoutineBundleSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+
+        # Reserva el espacio de todos los archivos del paquete (los que se 
+        # reutilicen no se descuentan al confirmar)
+        file_size = serializer.validated_data['total_size']
+
+        with StorageReservation(request.user, file_size) as reservation:
+            instance = serializer.save(reservation=reservation)
+
+        response_data = self.get_serializer(instance).data
+        response_data['json_rutina'] = get_routine_document(instance)
+
+        return Response(response_data, status=status.HTTP_201_CREATED)
+
+
+# ----- Subidas por partes -----
+class UploadSessionViewSet(viewsets.GenericViewSet):
+    """
+    Subida reanudable de audios y portadas de rutinas:
+
+    1. POST /subidas/ con name, target, filename, content_type y size.
+    2. PATCH /subidas/<id>/ con los bytes de cada parte en el cuerpo y su 
+       posición en el header Upload-Offset. Si la conexión se corta, 
+       GET /subidas/<id>/ indica desde dónde continuar.
+    3. POST /subidas/<id>/finalize/ (con json, si es la portada de una 
+       rutina) crea el contenido con el archivo ya armado en disco.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    parser_classes = (JSONParser, MultiPartParser, FormParser)
+    model = serializer_class.Meta.model
+
+    # ----- get_queryset -----
+    def get_queryset(self):
+        return self.model.objects.filter(user=self.request.user.id)
+    
+    # ----- get_offset_headers -----
+    def get_offset_headers(self, session):
+        return {
+            'Upload-Offset': str(session.offset),
+            'Upload-Length': str(session.size),
+        }
+    
+    # ----- create -----
+    def create(self, request, *args, **kwargs):
+        if not request.data:
+            raise exceptions.NotFound('No hay datos en la petición.')
+        
+        remove_expired_upload_sessions(request.user)
+        
+        data = {
+            'nombre': request.data.get('name'),
+            'target': request.data.get('target'),
+            'filename': request.data.get('filename'),
+            'content_type': request.data.get('content_type'),
+            'size': request.data.get('size'),
+        }
+        serializer = self.get_serializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        session = create_upload_session(serializer, request.user)
+
+        return Response(
+            serializer.data, 
+            status=status.HTTP_201_CREATED, 
+            headers=self.get_offset_headers(session),
+        )
+    
+    # ----- retrieve -----
+    def retrieve(self, request, *args, **kwargs):
+        session = self.get_object()
+        serializer = self.get_serializer(session)
+
+        return Response(
+            serializer.data, 
+            status=status.HTTP_200_OK, 
+            headers=self.get_offset_headers(session),
+        )
+    
+    # ----- partial_update -----
+    def partial_update(self, request, *args, **kwargs):
+        session = self.get_object()
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+        except (KeyError, ValueError):
+            msg = 'Se requieren los headers Upload-Offset y Content-Length.'
+            raise exceptions.ValidationError(msg)
+
+        # Sólo se puede reenviar lo ya recibido o continuar desde el final
+        if offset < 0 or offset > session.offset:
+            return Response(
+                {'message': 'El offset no coincide con lo recibido.'},
+                status=status.HTTP_409_CONFLICT,
+                headers=self.get_offset_headers(session),
+            )
+        
+        if length <= 0 or offset + length > session.size:
+            msg = 'La parte excede el tamaño declarado del archivo.'
+            raise exceptions.ValidationError(msg)
+
+        # El cuerpo se lee directo del stream, sin pasar por los parsers
+        write_upload_chunk(session, offset, request.stream, length)
+
+        return Response(
+            status=status.HTTP_204_NO_CONTENT, 
+            headers=self.get_offset_headers(session),
+        )
+    
+    # ----- destroy -----
+    def destroy(self, request, *args, **kwargs):
+        session = self.get_object()
+        remove_upload_session(session)
+
+        msg = {'message': 'Upload cancelled successfully.'}
+
+        return Response(msg, status=status.HTTP_200_OK)
+    
+    # ----- finalize -----
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, *args, **kwargs):
+        session = self.get_object()
+
+        if session.offset != session.size:
+            return Response(
+                {'message': 'La subida todavía no está completa.'},
+                status=status.HTTP_409_CONFLICT,
+                headers=self.get_offset_headers(session),
+            )
+        
+        file = get_upload_session_file(session)
+
+        if session.target == 'audio':
+            serializer_class = AudioSerializer
+            data = {
+                'nombre': session.nombre, 
+                'ruta': file, 
+                'autor': request.user.id
+            }
+        else:
+            serializer_class = RutinaSerializer
+            data = {
+                'nombre': session.nombre, 
+                'json_rutina': request.data.get('json'),
+                'url_portada': file, 
+                'autor': request.user.id
+            }
+
+        serializer = serializer_class(
+            data=data, 
+            context={'request': request}
+        )
+
+        try:
+            # La reserva de la subida se cambia por la del flujo de creación
+            # en la misma transacción: si algo falla, se revierte y la subida
+            # conserva su reserva
+            with transaction.atomic():
+                release_upload_reservation(session)
+                serializer.is_valid(raise_exception=True)
+
+                # Mismo flujo de creación que una subida en un único request
+                reservation = StorageReservation(request.user, session.size)
+                reservation.acquire()
+                serializer.save(autor=request.user.id, reservation=reservation)
+
+                remove_upload_session(session, release_storage=False)
+        finally:
+            file.close()
+
+        if serializer.data.get('estado') == 'pendiente':
+            status_code = status.HTTP_202_ACCEPTED
+        else:
+            status_code = status.HTTP_201_CREATED
+
+        return Response(serializer.data, status=status_code)
@@ -244,6 +244,103 @@ MEDIA_URL = 'media/'
 
 MEDIA_ROOT = os.environ['MEDIA_ROOT']
 
+# Carpeta para las subidas que Django guarda en disco mientras se procesan.
+# Si está en el mismo sistema de archivos que MEDIA_ROOT, los archivos se 
+# mueven a su destino en vez de copiarse.
+FILE_UPLOAD_TEMP_DIR = os.environ.get('FILE_UPLOAD_TEMP_DIR') or None
+
+# Almacenamiento por contenido: los pictogramas y audios idénticos se 
+# guardan una sola vez en MEDIA_ROOT/blobs/ y se comparten entre instancias.
+CONTENT_ADDRESSED_STORAGE = eval(
+    os.environ.get('CONTENT_ADDRESSED_STORAGE', 'False')
+)
+
+# Tamaños (en píxeles) de las miniaturas generadas para pictogramas y portadas
+THUMBNAIL_SIZES = (64, 128, 256)
+
+# Procesamiento de archivos en segundo plano (ver el comando run_worker).
+# Si está desactivado, las miniaturas se generan durante la petición.
+MEDIA_PROCESSING_ASYNC = eval(os.environ.get('MEDIA_PROCESSING_ASYNC', 'False'))
+
+# Reintentos de una tarea fallida y tiempo tras el cual una tarea en curso
+# se considera abandonada (en segundos)
+PROCESSING_JOB_MAX_ATTEMPTS = 3
+
+PROCESSING_JOB_TIMEOUT = 10 * 60
+
+# Subidas reanudables: carpeta de los archivos parciales (dentro de MEDIA_ROOT
+# para que al finalizar se muevan sin copiarse), tamaño máximo de lectura por
+# vez, horas tras las cuales una subida sin terminar se descarta (ver el 
+# comando clean_upload_sessions) y subidas abiertas a la vez por usuario
+CHUNKED_UPLOAD_DIR = os.path.join(MEDIA_ROOT, 'uploads')
+
+CHUNKED_UPLOAD_READ_SIZE = 64 * 1024
+
+CHUNKED_UPLOAD_EXPIRY_HOURS = 24
+
+CHUNKED_UPLOAD_MAX_SESSIONS = 5
+
+# Subidas en lote: cantidad máxima de archivos por petición y de hilos que
+# los escriben en disco en paralelo
+BATCH_UPLOAD_MAX_FILES = 200
+
+BATCH_UPLOAD_WORKERS = 8
+
+DATA_UPLOAD_MAX_NUMBER_FILES = BATCH_UPLOAD_MAX_FILES
+
+# Guarda el JSON de las rutinas en la base de datos (Rutina.documento) en vez
+# de un archivo por rutina en disco. Los documentos ya guardados en la base 
+# de datos se leen de ahí en cualquier caso.
+ROUTINE_DOCUMENTS_IN_DATABASE = eval(
+    os.environ.get('ROUTINE_DOCUMENTS_IN_DATABASE', 'False')
+)
+
+# Caché de los JSON de rutinas leídos desde disco: cantidad máxima de 
+# documentos en memoria de cada proceso y, opcionalmente, el alias (en 
+# CACHES) de una caché compartida entre procesos
+ROUTINE_CACHE_SIZE = 256
+
+ROUTINE_CACHE_BACKEND = os.environ.get('ROUTINE_CACHE_BACKEND') or None
+
+# Al consultar una rutina, copia su JSON tal como está guardado en la 
+# respuesta, sin decodificarlo y volver a codificarlo
+ROUTINE_JSON_PASSTHROUGH = eval(
+    os.environ.get('ROUTINE_JSON_PASSTHROUGH', 'False')
+)
+
+# Listados de pictogramas, audios y rutinas paginados por cursor: tamaño de
+# página por defecto y máximo que se puede pedir con 'page_size'
+CONTENT_PAGE_SIZE = int(os.environ.get('CONTENT_PAGE_SIZE', 50))
+
+CONTENT_MAX_PAGE_SIZE = int(os.environ.get('CONTENT_MAX_PAGE_SIZE', 200))
+
+# Obsoleto: mientras esté activo, un listado pedido sin 'cursor' ni 
+# 'page_size' se entrega completo (sin paginar) con el encabezado 
+# 'Deprecation', para los clientes que aún no usan el cursor
+CONTENT_LEGACY_UNPAGINATED = eval(
+    os.environ.get('CONTENT_LEGACY_UNPAGINATED', 'False')
+)
+
+# Catálogo precargado (pictogramas y audios) serializado una vez y compartido
+# por todos los usuarios: alias (en CACHES) de una caché compartida entre 
+# procesos, duración en segundos y espera máxima mientras otra petición lo 
+# vuelve a armar. Si no se configura el alias, no se usa caché. Sólo se usa
+# en los listados sin paginar (CONTENT_LEGACY_UNPAGINATED)
+PRELOADED_CATALOG_CACHE = os.environ.get('PRELOADED_CATALOG_CACHE') or None
+
+PRELOADED_CATALOG_TIMEOUT = 24 * 60 * 60
+
+PRELOADED_CATALOG_LOCK_TIMEOUT = 30
+
+# Sincronización incremental (/api/sync/): segundos que se restan al token 
+# para incluir los cambios de transacciones aún en curso
+SYNC_TOKEN_MARGIN = 60
+
+# Cantidad de sugerencias por defecto y máxima del autocompletado de nombres
+AUTOCOMPLETE_LIMIT = 10
+
+AUTOCOMPLETE_MAX_LIMIT = 50
+
 
 # reCAPTCHA settings
 DRF_RECAPTCHA_SECRET_KEY = os.environ["DRF_RECAPTCHA_SECRET_KEY"]